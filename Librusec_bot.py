@@ -1,6 +1,7 @@
 ﻿import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 import zipfile
+import zlib
 import os
 import json
 import sys
@@ -11,7 +12,30 @@ from telebot.apihelper import ApiTelegramException
 import io
 import sqlite3
 import hashlib
+import heapq
+import pickle
+import unicodedata
+import threading
+import time
+import html
+import atexit
+import signal
+import struct
+import multiprocessing
+import shutil
+import weakref
+import tempfile
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import count, repeat
+from collections import OrderedDict
 from lxml import etree
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 BOT_TOKEN = os.getenv('BOT_TOKEN', None) 
 
@@ -33,11 +57,41 @@ USERS_JSON_FILE = "/app/data/users_librusec.json"
 PENDING_USERS_JSON_FILE = "/app/data/pending_users_librusec.json"
 LOG_FILE = "/app/log/Log_librusecBase_bot.log"
 DB_FILE = "/app/data/reader_data.db"
+# Бинарный снимок разобранного каталога: позволяет не парсить INPX при каждом запуске
+CATALOG_SNAPSHOT_FILE = os.path.join(os.path.dirname(DB_FILE), "catalog_snapshot.bin")
+# База каталога для CATALOG_BACKEND=sqlite
+CATALOG_DB_FILE = os.path.join(os.path.dirname(DB_FILE), "catalog.db")
+# Индекс смещений файлов книг внутри ZIP-архивов библиотеки
+MEMBER_INDEX_FILE = os.path.join(os.path.dirname(DB_FILE), "member_index.bin")
 
 # 3. Настройки
 # Читаем из окружения, если не задано, используем значение по умолчанию
 PAGE_SIZE = int(os.getenv('PAGE_SIZE', 2000))
 MAX_BOOKS = int(os.getenv('MAX_BOOKS', 10))
+# Число процессов для параллельного разбора INP-файлов при холодной загрузке каталога
+INPX_WORKERS = int(os.getenv('INPX_WORKERS', os.cpu_count() or 1))
+# Где держать каталог: "memory" - в памяти процесса (быстрее всего),
+# "sqlite" - в базе SQLite с FTS5 на диске (для хостов с малым объёмом памяти)
+CATALOG_BACKEND = os.getenv('CATALOG_BACKEND', 'memory').strip().lower()
+# Общий кэш результатов поиска: число запросов, суммарное число номеров книг и время жизни (сек)
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 256))
+QUERY_CACHE_MAX_ROWS = int(os.getenv('QUERY_CACHE_MAX_ROWS', 2000000))
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', 600))
+# Интервал (в секундах) фоновой проверки INPX на новые архивы; 0 - проверка отключена
+CATALOG_WATCH_INTERVAL = int(os.getenv('CATALOG_WATCH_INTERVAL', 0))
+# 1 - не загружать в каталог книги, помеченные в INPX как удалённые (DEL=1)
+CATALOG_DROP_DELETED = os.getenv('CATALOG_DROP_DELETED', '0').strip() == '1'
+# Лимит времени (сек) на исправление опечаток в запросе, если точный поиск ничего не нашёл
+FUZZY_SEARCH_TIMEOUT = float(os.getenv('FUZZY_SEARCH_TIMEOUT', 0.3))
+# Книги размером до STREAM_MAX_BYTES отправляются прямо из памяти, более крупные
+# временно выгружаются на диск в DOWNLOAD_FOLDER
+STREAM_MAX_BYTES = int(os.getenv('STREAM_MAX_BYTES', 16 * 1024 * 1024))
+# Размер блока при копировании книги из архива в поток
+STREAM_CHUNK_SIZE = 256 * 1024
+# Интервал (сек) записи прогресса чтения в базу пачкой; 0 - записывать сразу при каждом листании
+PROGRESS_FLUSH_INTERVAL = float(os.getenv('PROGRESS_FLUSH_INTERVAL', 5))
+# Сколько архивов с книгами держать открытыми (с разобранным оглавлением ZIP)
+ARCHIVE_POOL_SIZE = int(os.getenv('ARCHIVE_POOL_SIZE', 8))
 
 # =================================================================
 # ПРОВЕРКА КРИТИЧЕСКИХ НАСТРОЕК
@@ -50,12 +104,1796 @@ if not BOT_TOKEN:
 os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
 
 
+# Версия формата индекса файлов книг в архивах
+MEMBER_INDEX_VERSION = 1
+# Размер локального заголовка файла в ZIP до имени и дополнительного поля
+ZIP_LOCAL_HEADER_SIZE = 30
+# Сколько примеров отсутствующих в архивах книг выводить в лог при проверке
+MISSING_BOOKS_LOG_LIMIT = 5
+
 # Поля в .inp файле
 FIELDS = ['AUTHOR', 'GENRE', 'TITLE', 'SERIES', 'SERNO', 'FILE', 'SIZE', 'LIBID', 'DEL', 'EXT', 'DATE', 'LANG', 'RATING', 'KEYWORDS']
+# Все поля записи каталога (включая вычисляемое имя архива с книгами)
+CATALOG_FIELDS = FIELDS + ['INP_ARCHIVE_NAME']
+
+# Способ хранения полей в колоночном каталоге:
+# - часто повторяющиеся значения храним словарём (код -> строка),
+# - числовые поля храним массивами целых чисел,
+# - остальной текст храним одним блоком UTF-8 байт со смещениями.
+DICT_FIELDS = ('AUTHOR', 'GENRE', 'SERIES', 'LANG', 'EXT', 'INP_ARCHIVE_NAME', 'DEL', 'DATE', 'RATING', 'KEYWORDS')
+INT_FIELDS = ('SIZE', 'SERNO', 'LIBID')
+TEXT_FIELDS = ('TITLE', 'FILE')
+# Версия формата снимка каталога: увеличивается при изменении структуры BookCatalog
+CATALOG_SNAPSHOT_VERSION = 10
+# Поля, из которых состоит предвычисленный ключ поиска (в этом порядке)
+SEARCH_KEY_FIELDS = ('AUTHOR', 'TITLE', 'SERIES', 'SERNO')
+# Поля ключа поиска, для которых хранится транслитерированный вариант (в SQLite - колонки tkey_*)
+TRANSLIT_KEY_FIELDS = ('AUTHOR', 'TITLE', 'SERIES')
+# Транслитерация сводит кириллицу и латиницу разных схем (ГОСТ 7.79, ISO 9, бытовая
+# "sh/ch/ya") к одному латинскому "скелету": сначала буквы кириллицы и диакритика ISO 9,
+# затем буквосочетания латиницы, затем одиночные латинские буквы
+TRANSLIT_TABLE = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's',
+    'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': '',
+    'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'iu', 'я': 'ia', 'і': 'i', 'ї': 'i', 'є': 'e', 'ґ': 'g',
+    'ў': 'u', 'š': 'sh', 'č': 'ch', 'ž': 'zh', 'ŝ': 'sh', 'û': 'iu', 'â': 'ia', 'ë': 'e', 'è': 'e',
+    'é': 'e', 'ʹ': '', 'ʺ': '', "'": '', '`': '', '’': '',
+})
+TRANSLIT_DIGRAPHS = (('shch', 'sh'), ('tsch', 'ch'), ('sch', 'sh'), ('shh', 'sh'), ('kh', 'h'), ('ts', 'c'),
+                     ('tz', 'c'), ('cz', 'c'), ('ye', 'e'), ('yo', 'e'), ('x', 'ks'))
+TRANSLIT_LETTERS = str.maketrans({'y': 'i', 'j': 'i', 'w': 'v', 'q': 'k'})
+# Поля с индексом различных значений для последовательного поиска (TITLE ищется по триграммам)
+FIELD_INDEX_FIELDS = ('AUTHOR', 'SERIES', 'SERNO', 'DATE')
+# Планировщик пересекает множества кандидатов, пока следующее не больше текущего в N раз;
+# остальные критерии проверяются напрямую по ключам кандидатов
+PLANNER_INTERSECT_RATIO = 4
+# Поля, по которым строится хеш-индекс для поиска книги за O(1)
+INDEXED_FIELDS = ('LIBID', 'FILE')
+# Поля, индексы значений которых служат фасетами для просмотра ("Все книги серии/автора")
+FACET_FIELDS = ('AUTHOR', 'SERIES')
+# Названия групп жанров FB2 (по префиксу кода жанра) для просмотра "Жанры"
+GENRE_GROUPS = {
+    'sf': 'Фантастика', 'det': 'Детективы', 'prose': 'Проза', 'love': 'Любовные романы',
+    'adv': 'Приключения', 'child': 'Детское', 'poetry': 'Поэзия', 'dramaturgy': 'Драматургия',
+    'antique': 'Старинное', 'sci': 'Наука и образование', 'comp': 'Компьютеры', 'ref': 'Справочники',
+    'nonf': 'Документальное', 'religion': 'Религия', 'humor': 'Юмор', 'home': 'Дом и семья',
+    'thriller': 'Триллеры', 'fantasy': 'Фэнтези', 'military': 'Военное', 'economics': 'Экономика',
+}
+# Поля, по словам которых строится индекс для исправления опечаток (BK-дерево)
+FUZZY_FIELDS = ('AUTHOR', 'SERIES')
+# Слова короче этой длины не исправляются: для них слишком много похожих
+FUZZY_MIN_LENGTH = 4
+# Поля с битовыми картами значений для фильтров поиска
+FILTER_FIELDS = ('DEL', 'LANG', 'EXT')
+# Фильтры поиска - кортеж (скрывать удалённые, языки, форматы); языки и форматы
+# в нижнем регистре и отсортированы, пустой кортеж - без ограничения
+NO_FILTERS = (False, (), ())
+DEFAULT_SEARCH_FILTERS = (True, (), ())
+# Сколько готовых масок фильтров хранить в каталоге
+FILTER_MASK_CACHE_SIZE = 32
+# Колонки таблицы books каталога SQLite в порядке CATALOG_FIELDS
+SQLITE_BOOK_COLUMNS = ', '.join(field.lower() for field in CATALOG_FIELDS)
+
+
+# =================================================================
+# КОЛОНОЧНЫЙ КАТАЛОГ КНИГ
+# =================================================================
+
+class DictColumn:
+    """Колонка со словарным кодированием: каждая строка хранится один раз."""
+
+    def __init__(self):
+        self.codes = array('I')
+        self.values = []
+        self._lookup = {}
+
+    def append(self, value):
+        code = self._lookup.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self._lookup[value] = code
+        self.codes.append(code)
+
+    def extend(self, other):
+        """Дописывает другую словарную колонку, перекодируя её значения."""
+        if not self._lookup and self.values:
+            self._lookup = {value: code for code, value in enumerate(self.values)}
+        remap = []
+        for value in other.values:
+            code = self._lookup.get(value)
+            if code is None:
+                code = len(self.values)
+                self.values.append(value)
+                self._lookup[value] = code
+            remap.append(code)
+        self.codes.extend(remap[code] for code in other.codes)
+
+    def slice(self, start, end):
+        part = DictColumn()
+        part.codes = self.codes[start:end]
+        part.values = self.values
+        return part
+
+    def freeze(self):
+        """Освобождает вспомогательный словарь, нужный только при построении."""
+        self._lookup = {}
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def nbytes(self):
+        return (self.codes.itemsize * len(self.codes) + sys.getsizeof(self.values)
+                + sum(sys.getsizeof(value) for value in self.values))
+
+
+class IntColumn:
+    """
+    Колонка целых чисел. Пустое значение хранится как -1, а редкие нечисловые
+    (или с ведущими нулями) значения - в отдельном словаре, чтобы строковое
+    представление поля не отличалось от исходного INPX.
+    """
+    EMPTY = -1
+    RAW = -2
+
+    def __init__(self):
+        self.values = array('q')
+        self.raw = {}
+
+    def append(self, value):
+        if value.isascii() and value.isdigit() and len(value) < 19 and str(int(value)) == value:
+            self.values.append(int(value))
+        elif not value:
+            self.values.append(self.EMPTY)
+        else:
+            self.raw[len(self.values)] = value
+            self.values.append(self.RAW)
+
+    def extend(self, other):
+        base = len(self.values)
+        self.values.extend(other.values)
+        self.raw.update((base + index, value) for index, value in other.raw.items())
+
+    def slice(self, start, end):
+        part = IntColumn()
+        part.values = self.values[start:end]
+        part.raw = {index - start: value for index, value in self.raw.items() if start <= index < end}
+        return part
+
+    def freeze(self):
+        pass
+
+    def number(self, index):
+        """Возвращает числовое значение или None, если поле пустое или не число."""
+        value = self.values[index]
+        return value if value >= 0 else None
+
+    def __getitem__(self, index):
+        value = self.values[index]
+        if value >= 0:
+            return str(value)
+        if value == self.EMPTY:
+            return ''
+        return self.raw[index]
+
+    def nbytes(self):
+        return (self.values.itemsize * len(self.values) + sys.getsizeof(self.raw)
+                + sum(sys.getsizeof(value) for value in self.raw.values()))
+
+
+class TextColumn:
+    """Колонка произвольного текста: один блок UTF-8 байт и массив смещений."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('I', [0])
+
+    def append(self, value):
+        self.data += value.encode('utf-8')
+        self.offsets.append(len(self.data))
+
+    def extend(self, other):
+        base = len(self.data)
+        self.data += other.data
+        self.offsets.extend(base + offset for offset in other.offsets[1:])
+
+    def slice(self, start, end):
+        part = TextColumn()
+        base = self.offsets[start]
+        part.data = self.data[base:self.offsets[end]]
+        part.offsets = array('I', (offset - base for offset in self.offsets[start:end + 1]))
+        return part
+
+    def freeze(self):
+        pass
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+
+    def nbytes(self):
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+class HashIndex:
+    """
+    Хеш-индекс поля каталога (открытая адресация). Хранит только номера записей,
+    ключ сравнивается со значением в колонке. Для повторяющихся ключей
+    возвращается первая по порядку запись - как при линейном поиске.
+    """
+
+    def __init__(self, column, count):
+        capacity = 1 << max(3, (2 * count).bit_length())
+        self.mask = capacity - 1
+        self.slots = array('i', [-1]) * capacity
+        for index in range(count):
+            key = column[index]
+            if not key:
+                continue
+            slot = zlib.crc32(key.encode('utf-8')) & self.mask
+            while True:
+                row = self.slots[slot]
+                if row < 0:
+                    self.slots[slot] = index
+                    break
+                if column[row] == key:
+                    break
+                slot = (slot + 1) & self.mask
+
+    def get(self, column, key):
+        """Возвращает номер записи с данным ключом или None."""
+        slot = zlib.crc32(key.encode('utf-8')) & self.mask
+        while True:
+            row = self.slots[slot]
+            if row < 0:
+                return None
+            if column[row] == key:
+                return row
+            slot = (slot + 1) & self.mask
+
+    def nbytes(self):
+        return self.slots.itemsize * len(self.slots)
+
+
+class TrigramIndex:
+    """
+    Инвертированный индекс по триграммам строк умного поиска: для каждой
+    триграммы хранит отсортированный массив номеров записей, где она встречается.
+    """
+    GRAM = 3
+
+    def __init__(self):
+        self.postings = {}
+
+    def add(self, index, text):
+        for gram in {text[i:i + self.GRAM] for i in range(len(text) - self.GRAM + 1)}:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('I')
+            posting.append(index)
+
+    def candidates(self, parts):
+        """
+        Возвращает отсортированный список записей, которые могут содержать все части
+        запроса, или None, если части слишком короткие для индекса (нужен полный просмотр).
+        """
+        grams = {part[i:i + self.GRAM] for part in parts for i in range(len(part) - self.GRAM + 1)}
+        if not grams:
+            return None
+        postings = []
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            result.intersection_update(posting)
+            if not result:
+                return []
+        return sorted(result)
+
+    def estimate(self, parts):
+        """
+        Верхняя оценка числа записей, содержащих все части запроса: длина самого
+        короткого списка триграммы. None, если части слишком короткие для индекса.
+        """
+        grams = {part[i:i + self.GRAM] for part in parts for i in range(len(part) - self.GRAM + 1)}
+        if not grams:
+            return None
+        return min(len(self.postings.get(gram, ())) for gram in grams)
+
+    def nbytes(self):
+        return sys.getsizeof(self.postings) + sum(
+            sys.getsizeof(gram) + posting.itemsize * len(posting) + 64 for gram, posting in self.postings.items())
+
+
+class FieldIndex:
+    """
+    Индекс одного поля для последовательного поиска: различные нормализованные
+    значения поля и для каждого значения - массив номеров записей с ним.
+    Поиск подстроки идёт по различным значениям, а не по всем книгам.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.postings = []
+        self._lookup = {}
+
+    def add(self, index, value):
+        code = self._lookup.get(value)
+        if code is None:
+            code = self._lookup[value] = len(self.values)
+            self.values.append(value)
+            self.postings.append(array('I'))
+        self.postings[code].append(index)
+
+    def freeze(self, keep_lookup=False):
+        """Завершает построение; keep_lookup - оставить словарь значений для get() (фасеты)."""
+        if not keep_lookup:
+            self._lookup = {}
+
+    def get(self, value):
+        """Номера записей с точным значением value (один поиск в словаре) или пустой массив."""
+        code = self._lookup.get(value)
+        return self.postings[code] if code is not None else array('I')
+
+    def counts(self):
+        """Число записей для каждого значения."""
+        return {value: len(posting) for value, posting in zip(self.values, self.postings)}
+
+    def matching(self, needle):
+        """Коды значений, содержащих подстроку needle."""
+        return [code for code, value in enumerate(self.values) if needle in value]
+
+    def estimate(self, codes):
+        """Точное число записей с данными значениями."""
+        return sum(len(self.postings[code]) for code in codes)
+
+    def rows(self, codes):
+        result = set()
+        for code in codes:
+            result.update(self.postings[code])
+        return result
+
+    def nbytes(self):
+        return (sys.getsizeof(self.values) + sum(sys.getsizeof(value) for value in self.values)
+                + sum(posting.itemsize * len(posting) + 64 for posting in self.postings))
+
+
+class BKTree:
+    """
+    BK-дерево различных слов поля (фамилий, имён, слов названий серий) для поиска
+    похожих слов по расстоянию Левенштейна. Узлы хранятся плоскими списками (слово
+    и число значений поля с ним), рёбра - одним словарём {узел * 64 + расстояние: потомок}.
+    """
+    MAX_WORD = 64
+
+    def __init__(self):
+        self.words = []
+        self.counts = array('I')
+        self.edges = {}
+        self._lookup = {}
+
+    @classmethod
+    def from_values(cls, values):
+        """Строит дерево по словам различных нормализованных значений поля."""
+        tree = cls()
+        for value in values:
+            for word in set(re.findall(r'[^\W\d_]+', value)):
+                if FUZZY_MIN_LENGTH <= len(word) < cls.MAX_WORD:
+                    tree.add(word)
+        tree._lookup = {}
+        return tree
+
+    def add(self, word):
+        node = self._lookup.get(word)
+        if node is not None:
+            self.counts[node] += 1
+            return
+        self._lookup[word] = len(self.words)
+        self.words.append(word)
+        self.counts.append(1)
+        if len(self.words) == 1:
+            return
+        masks = pattern_masks(word)
+        node = 0
+        while True:
+            edge = node * self.MAX_WORD + levenshtein(word, masks, self.words[node])
+            child = self.edges.get(edge)
+            if child is None:
+                self.edges[edge] = len(self.words) - 1
+                return
+            node = child
+
+    def closest(self, word, max_distance, deadline):
+        """
+        Ближайшее к word слово дерева на расстоянии не больше max_distance
+        (при равенстве - более частое) в виде (расстояние, слово), или None.
+        Поиск прекращается по достижении deadline (time.monotonic()).
+        """
+        if not self.words:
+            return None
+        masks = pattern_masks(word)
+        best = None
+        stack = [0]
+        visited = 0
+        while stack:
+            visited += 1
+            if not visited & 63 and time.monotonic() > deadline:
+                logger.debug(f"Поиск похожих слов для '{word}' прерван по времени.")
+                break
+            node = stack.pop()
+            distance = levenshtein(word, masks, self.words[node])
+            if distance <= max_distance:
+                candidate = (distance, -self.counts[node], self.words[node])
+                if best is None or candidate < best:
+                    best = candidate
+                    max_distance = distance
+            base = node * self.MAX_WORD
+            for child_distance in range(max(1, distance - max_distance), min(self.MAX_WORD, distance + max_distance + 1)):
+                child = self.edges.get(base + child_distance)
+                if child is not None:
+                    stack.append(child)
+        return (best[0], best[2]) if best is not None else None
+
+    def nbytes(self):
+        return (sys.getsizeof(self.words) + sum(sys.getsizeof(word) for word in self.words)
+                + self.counts.itemsize * len(self.counts) + sys.getsizeof(self.edges))
+
+
+class BitmapIndex:
+    """
+    Битовые карты поля со словарным кодированием (DEL, LANG, EXT): для каждого значения
+    (без учёта регистра) - строка байт, в которой бит i установлен у записей с этим значением.
+    Фильтры объединяются побитовыми операциями над целыми числами, без обхода записей.
+    """
+
+    def __init__(self, column, count):
+        keys = [value.strip().lower() for value in column.values]
+        bitmaps = {}
+        for index, code in enumerate(column.codes):
+            bitmap = bitmaps.get(keys[code])
+            if bitmap is None:
+                bitmap = bitmaps[keys[code]] = bytearray((count + 7) >> 3)
+            bitmap[index >> 3] |= 1 << (index & 7)
+        self.bitmaps = {key: bytes(bitmap) for key, bitmap in bitmaps.items()}
+        self.counts = {key: int.from_bytes(bitmap, 'little').bit_count() for key, bitmap in bitmaps.items()}
+
+    def mask(self, values):
+        """Объединение битовых карт значений values в виде целого числа."""
+        result = 0
+        for value in values:
+            bitmap = self.bitmaps.get(value)
+            if bitmap is not None:
+                result |= int.from_bytes(bitmap, 'little')
+        return result
+
+    def common(self, limit):
+        """Самые частые непустые значения поля."""
+        values = sorted((key for key in self.counts if key), key=self.counts.get, reverse=True)
+        return values[:limit]
+
+    def nbytes(self):
+        return sys.getsizeof(self.bitmaps) + sum(len(bitmap) for bitmap in self.bitmaps.values())
+
+
+def make_column(field):
+    """Создает пустую колонку подходящего типа для поля каталога."""
+    if field in DICT_FIELDS:
+        return DictColumn()
+    if field in INT_FIELDS:
+        return IntColumn()
+    return TextColumn()
+
+
+class BookRecord:
+    """
+    Лёгкое представление записи каталога. Ведёт себя как словарь книги
+    (book['TITLE'], book.get('SIZE', 0)), но не хранит строк у себя.
+    """
+    __slots__ = ('catalog', 'index')
+
+    def __init__(self, catalog, index):
+        self.catalog = catalog
+        self.index = index
+
+    def __getitem__(self, field):
+        return self.catalog.columns[field][self.index]
+
+    def get(self, field, default=None):
+        column = self.catalog.columns.get(field)
+        return column[self.index] if column is not None else default
+
+    def keys(self):
+        return list(CATALOG_FIELDS)
+
+    def to_dict(self):
+        return {field: self[field] for field in CATALOG_FIELDS}
+
+    def __eq__(self, other):
+        return isinstance(other, BookRecord) and self.catalog is other.catalog and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.catalog), self.index))
+
+    def __repr__(self):
+        return f"BookRecord({self.index}, LIBID={self['LIBID']!r}, TITLE={self['TITLE']!r})"
+
+
+class SearchCursor:
+    """
+    Возобновляемый курсор поиска. Хранит не список найденных книг, а сам запрос
+    (режим и нормализованные критерии), точное число результатов и окно из нескольких
+    ранжированных страниц вокруг текущей позиции - память на пользователя постоянна.
+
+    Номера найденных записей (с учётом фильтров пользователя) берутся из общего кэша
+    (query_cache); если запрос оттуда
+    вытеснен, поиск выполняется заново. Страницы выбираются в куче по мере листания:
+    следующие - среди записей, идущих по релевантности после окна, предыдущие - до него,
+    последние - с конца выдачи (heapq.nlargest). После обновления каталога курсор
+    переключается на новый каталог.
+    """
+    __slots__ = ('catalog', 'mode', 'criteria', 'filters', 'key', 'rank_key', 'total', 'window', 'window_start',
+                 'corrected', 'title')
+
+    def __init__(self, catalog, mode, criteria, filters=NO_FILTERS):
+        self.mode = mode
+        self.criteria = criteria
+        self.filters = filters
+        # Текст исправленного запроса, если курсор выдаёт результаты после исправления опечаток
+        self.corrected = None
+        # Заголовок выдачи при просмотре фасета (жанр, серия, автор)
+        self.title = None
+        self.key = (mode, filters) + tuple(criteria.values() if isinstance(criteria, dict) else criteria)
+        self.bind(catalog)
+
+    def bind(self, catalog):
+        """Привязывает курсор к каталогу и считает точное число результатов."""
+        self.catalog = catalog
+        self.rank_key = getattr(catalog, f'{self.mode}_rank_key')(self.criteria)
+        self.window = array('I')
+        self.window_start = 0
+        self.total = len(self.rows())
+
+    def rows(self):
+        """Номера всех найденных записей (в порядке каталога) из общего кэша."""
+        rows = query_cache.get(self.key, self.catalog.version)
+        if rows is None:
+            rows = array('I', getattr(self.catalog, f'search_{self.mode}')(self.criteria, self.filters))
+            query_cache.put(self.key, self.catalog.version, rows)
+        return rows
+
+    def __len__(self):
+        return self.total
+
+    def ranked_rows(self, start, stop):
+        """Номера записей с позиций [start, stop) в порядке релевантности."""
+        if self.catalog.version != books_data.version:
+            self.bind(books_data)
+        start, stop = max(start, 0), min(stop, self.total)
+        if start >= stop:
+            return []
+        if not self.window_start <= start or stop > self.window_start + len(self.window):
+            self.move_window(start, stop)
+        return list(self.window[start - self.window_start:stop - self.window_start])
+
+    def move_window(self, start, stop):
+        """Перестраивает окно так, чтобы оно покрывало позиции [start, stop)."""
+        span = max(stop - start, RANKED_PAGES_AHEAD * results_per_page)
+        rows = self.rows()
+        rank = self.rank_key
+        if rank is None:
+            # Порядок уже задан каталогом
+            self.window, self.window_start = rows[start:start + span], start
+            return
+        window_stop = self.window_start + len(self.window)
+        ranked = zip(map(rank, rows), rows)
+        if self.window and window_stop <= start and start - window_stop + span <= self.total - start:
+            # Листание вперёд: выбираем среди записей, идущих после окна
+            boundary = rank(self.window[-1])
+            skip = start - window_stop
+            found = heapq.nsmallest(skip + span, (item for item in ranked if item[0] > boundary))
+            window, lo = found[skip:], start
+        elif self.window and stop <= self.window_start and self.window_start - stop <= start:
+            # Листание назад: выбираем среди записей, идущих до окна
+            boundary = rank(self.window[0])
+            lo = max(0, min(start, self.window_start - span))
+            window = heapq.nlargest(self.window_start - lo, (item for item in ranked if item[0] < boundary))
+            window.reverse()
+        elif start <= self.total - stop:
+            # Переход к началу выдачи
+            window, lo = heapq.nsmallest(start + span, ranked)[start:], start
+        else:
+            # Переход к концу выдачи: ранжируем только хвост
+            lo = max(0, min(start, stop - span))
+            window = heapq.nlargest(self.total - lo, ranked)
+            window.reverse()
+            del window[max(span, stop - lo):]
+        self.window = array('I', (index for _, index in window))
+        self.window_start = lo
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, _ = item.indices(self.total)
+            return [BookRecord(self.catalog, index) for index in self.ranked_rows(start, stop)]
+        if item < 0:
+            item += self.total
+        rows = self.ranked_rows(item, item + 1)
+        if not rows:
+            raise IndexError(item)
+        return BookRecord(self.catalog, rows[0])
+
+    def __iter__(self):
+        for start in range(0, self.total, results_per_page):
+            for index in self.ranked_rows(start, start + results_per_page):
+                yield BookRecord(self.catalog, index)
+
+
+class BookCatalog:
+    """
+    Колоночное хранилище каталога INPX. Каждое поле лежит в своей колонке,
+    записи доступны по номеру строки в виде BookRecord.
+    members хранит для каждого INP-файла диапазон его записей и подпись
+    (CRC и размер), по которой определяется, изменился ли файл.
+    """
+
+    def __init__(self):
+        self.columns = {field: make_column(field) for field in CATALOG_FIELDS}
+        self.count = 0
+        self.version = 0
+        self.members = {}
+        self.indexes = {}
+        self.search_keys = TextColumn()
+        self.translit_keys = TextColumn()
+        self.search_index = TrigramIndex()
+        self.field_indexes = {}
+        self.filters = {}
+        self._filter_masks = {}
+        self.fuzzy_indexes = {}
+        self.facets = {}
+
+    def append(self, book_info):
+        """Добавляет книгу, заданную словарём строковых полей."""
+        for field, column in self.columns.items():
+            column.append(book_info.get(field, ''))
+        self.count += 1
+
+    def extend(self, other):
+        """Дописывает в конец записи другого (частичного) каталога."""
+        for field, column in self.columns.items():
+            column.extend(other.columns[field])
+        for name, (start, end, signature) in other.members.items():
+            self.members[name] = (self.count + start, self.count + end, signature)
+        self.count += other.count
+
+    def slice(self, start, end):
+        """Возвращает частичный каталог из записей [start, end)."""
+        part = BookCatalog()
+        part.columns = {field: column.slice(start, end) for field, column in self.columns.items()}
+        part.count = end - start
+        part.members = {name: (member_start - start, member_end - start, signature)
+                        for name, (member_start, member_end, signature) in self.members.items()
+                        if start <= member_start and member_end <= end}
+        return part
+
+    def build_indexes(self):
+        """Строит индексы для быстрого поиска по готовому каталогу."""
+        self.indexes = {field: HashIndex(self.columns[field], self.count) for field in INDEXED_FIELDS}
+        self.filters = {field: BitmapIndex(self.columns[field], self.count) for field in FILTER_FIELDS}
+        self._filter_masks = {}
+        self.search_keys = TextColumn()
+        self.translit_keys = TextColumn()
+        self.search_index = TrigramIndex()
+        self.field_indexes = {field: FieldIndex() for field in FIELD_INDEX_FIELDS}
+        date_column = self.columns['DATE']
+        for book in self:
+            key = smart_search_key(book)
+            translit_key = translit_text(key)
+            self.search_keys.append(key)
+            self.translit_keys.append(translit_key)
+            # Триграммы транслитерированного ключа идут в тот же индекс
+            self.search_index.add(book.index, f"{key}\n{translit_key}")
+            for field, value in zip(SEARCH_KEY_FIELDS, key.split('\n')):
+                if field in self.field_indexes:
+                    self.field_indexes[field].add(book.index, value)
+            self.field_indexes['DATE'].add(book.index, date_column[book.index])
+        for field, field_index in self.field_indexes.items():
+            field_index.freeze(keep_lookup=field in FACET_FIELDS)
+        # Фасеты: индексы автора и серии (книги серии - сразу по порядку номеров) и жанры по кодам
+        self.facets = {field: self.field_indexes[field] for field in FACET_FIELDS}
+        for posting in self.facets['SERIES'].postings:
+            posting[:] = array('I', sorted(posting, key=lambda index: (self.serno_sort_key(index), index)))
+        genres = FieldIndex()
+        genre_column = self.columns['GENRE']
+        for index in range(self.count):
+            for genre in genre_column[index].split(':'):
+                if genre:
+                    genres.add(index, genre)
+        genres.freeze(keep_lookup=True)
+        self.facets['GENRE'] = genres
+        self.fuzzy_indexes = {field: BKTree.from_values(self.field_indexes[field].values) for field in FUZZY_FIELDS}
+        return self
+
+    def serno_sort_key(self, index):
+        """Ключ сортировки по номеру в серии: число, нечисловые и пустые - в конец."""
+        column = self.columns['SERNO']
+        number = column.number(index)
+        if number is not None:
+            return number
+        raw = column.raw.get(index, '')
+        return int(raw) if raw.isascii() and raw.isdigit() else float('inf')
+
+    def filter_mask(self, filters):
+        """
+        Битовая маска записей, проходящих фильтры (скрывать удалённые, языки, форматы),
+        или None, если фильтры ничего не отсекают. Готовые маски кэшируются.
+        """
+        hide_deleted, languages, formats = filters
+        if not (hide_deleted or languages or formats):
+            return None
+        mask = self._filter_masks.get(filters)
+        if mask is None:
+            bits = (1 << self.count) - 1
+            if hide_deleted:
+                bits &= ~self.filters['DEL'].mask(['1'])
+            if languages:
+                bits &= self.filters['LANG'].mask(languages)
+            if formats:
+                bits &= self.filters['EXT'].mask(formats)
+            mask = bits.to_bytes((self.count + 7) >> 3, 'little')
+            if len(self._filter_masks) >= FILTER_MASK_CACHE_SIZE:
+                self._filter_masks.clear()
+            self._filter_masks[filters] = mask
+        return mask
+
+    def apply_filters(self, rows, filters):
+        """Оставляет из rows только записи, проходящие фильтры (проверка бита в маске)."""
+        mask = self.filter_mask(filters)
+        if mask is None:
+            return rows
+        return [index for index in rows if mask[index >> 3] >> (index & 7) & 1]
+
+    def filter_values(self, field, limit):
+        """Самые частые значения поля фильтра (для кнопок выбора)."""
+        return self.filters[field].common(limit) if field in self.filters else []
+
+    def search_smart(self, query_parts, filters=NO_FILTERS):
+        """
+        Умный поиск по нормализованным частям запроса. Возвращает номера найденных
+        записей в порядке каталога; упорядочивание - отдельно, по smart_rank_key.
+        """
+        return self._match_parts(self.search_keys, query_parts, filters)
+
+    def search_translit(self, query_pairs, filters=NO_FILTERS):
+        """
+        Умный поиск с транслитерацией: query_pairs - пары (часть запроса, её translit_text).
+        Часть совпадает, если она входит в обычный ключ книги или её транслитерация -
+        в транслитерированный: находит всё, что и search_smart, плюс книги в другой записи.
+        """
+        candidates = self._translit_candidates(query_pairs)
+        rows = range(self.count) if candidates is None else candidates
+        rows = self.apply_filters(rows, filters)
+        keys, translit_keys = self.search_keys, self.translit_keys
+        return [index for index in rows
+                if all(part in keys[index] or (translit_part and translit_part in translit_keys[index])
+                       for part, translit_part in query_pairs)]
+
+    def _translit_candidates(self, query_pairs):
+        # Для каждой пары - объединение кандидатов части и её транслитерации, между парами - пересечение
+        result = None
+        for part, translit_part in query_pairs:
+            found = self.search_index.candidates([part])
+            if found is not None and translit_part:
+                translit_found = self.search_index.candidates([translit_part])
+                found = None if translit_found is None else set(found).union(translit_found)
+            if found is None:
+                continue
+            result = set(found) if result is None else result.intersection(found)
+            if not result:
+                return []
+        return None if result is None else sorted(result)
+
+    def _match_parts(self, keys, query_parts, filters):
+        # Кандидаты из триграммного индекса; фильтры отсекают их до проверки подстрок
+        candidates = self.search_index.candidates(query_parts)
+        rows = range(self.count) if candidates is None else candidates
+        rows = self.apply_filters(rows, filters)
+        return [index for index in rows if all(part in keys[index] for part in query_parts)]
+
+    def search_fields(self, criteria, filters=NO_FILTERS):
+        """
+        Последовательный поиск: criteria - {поле: нормализованная подстрока или ''}.
+        Возвращает номера найденных записей в порядке каталога.
+        """
+        # Планировщик выбирает кандидатов по индексам полей, точная проверка - только для них
+        candidates = self.field_candidates(criteria)
+        rows = range(self.count) if candidates is None else candidates
+        rows = self.apply_filters(rows, filters)
+        checks = [(SEARCH_KEY_FIELDS.index(field), needle) for field, needle in criteria.items()
+                  if needle and field in SEARCH_KEY_FIELDS]
+        date = criteria.get('DATE')
+        date_column = self.columns['DATE']
+
+        results = []
+        for index in rows:
+            key = self.search_keys[index].split('\n')
+            if all(needle in key[position] for position, needle in checks) and (not date or date in date_column[index]):
+                results.append(index)
+        return results
+
+    def smart_rank_key(self, query_parts):
+        """
+        Ключ релевантности для умного поиска (меньше - выше в выдаче):
+        точное совпадение запроса с автором, названием или серией; затем число частей
+        запроса, найденных в авторе или названии (а не только в серии); затем книги
+        одной серии по порядку номеров; при равенстве - порядок каталога.
+        """
+        return self._parts_rank_key(self.search_keys, query_parts)
+
+    def translit_rank_key(self, query_pairs):
+        """
+        Ключ релевантности для поиска с транслитерацией (как smart_rank_key): часть запроса
+        считается найденной, если найдена она сама или её транслитерация.
+        """
+        phrase = ' '.join(part for part, _ in query_pairs)
+        translit_phrase = ' '.join(translit_part for _, translit_part in query_pairs if translit_part)
+        search_keys, translit_keys = self.search_keys, self.translit_keys
+
+        def rank(index):
+            author, title, series, _ = search_keys[index].split('\n')
+            translit_author, translit_title, translit_series, _ = translit_keys[index].split('\n')
+            primary_hits = sum(1 for part, translit_part in query_pairs
+                               if part in author or part in title
+                               or (translit_part and (translit_part in translit_author or translit_part in translit_title)))
+            exact = phrase in (author, title, series) or (
+                translit_phrase and translit_phrase in (translit_author, translit_title, translit_series))
+            return (not exact, -primary_hits, not series, series, self.serno_sort_key(index), index)
+        return rank
+
+    def _parts_rank_key(self, keys, query_parts):
+        phrase = ' '.join(query_parts)
+
+        def rank(index):
+            author, title, series, _ = keys[index].split('\n')
+            primary_hits = sum(1 for part in query_parts if part in author or part in title)
+            return (phrase not in (author, title, series), -primary_hits,
+                    not series, series, self.serno_sort_key(index), index)
+        return rank
+
+    def fields_rank_key(self, criteria):
+        """
+        Ключ релевантности для последовательного поиска: точные совпадения полей
+        (автор и название весят больше серии), затем серия и номер в ней.
+        """
+        weights = {'AUTHOR': 2, 'TITLE': 2}
+        checks = [(SEARCH_KEY_FIELDS.index(field), needle, weights.get(field, 1))
+                  for field, needle in criteria.items() if needle and field in SEARCH_KEY_FIELDS]
+        search_keys = self.search_keys
+
+        def rank(index):
+            key = search_keys[index].split('\n')
+            exact = sum(weight for position, needle, weight in checks if key[position] == needle)
+            series = key[2]
+            return (-exact, not series, series, self.serno_sort_key(index), index)
+        return rank
+
+    def genre_counts(self, filters=NO_FILTERS):
+        """Число книг по каждому коду жанра с учётом фильтров (жанры без подходящих книг опускаются)."""
+        genres = self.facets['GENRE']
+        if self.filter_mask(filters) is None:
+            return genres.counts()
+        counts = {value: len(self.apply_filters(posting, filters)) for value, posting in zip(genres.values, genres.postings)}
+        return {value: number for value, number in counts.items() if number}
+
+    def facet_count(self, field, value, filters=NO_FILTERS):
+        """Число книг с нормализованным значением value поля AUTHOR или SERIES (с учётом фильтров)."""
+        return len(self.apply_filters(self.facets[field].get(value), filters))
+
+    def search_genre(self, criteria, filters=NO_FILTERS):
+        """Книги жанра criteria[0] в порядке каталога - готовый список из фасета."""
+        return self.apply_filters(self.facets['GENRE'].get(criteria[0]), filters)
+
+    def search_series(self, criteria, filters=NO_FILTERS):
+        """Книги серии (нормализованное название criteria[0]), уже упорядоченные по номерам."""
+        return self.apply_filters(self.facets['SERIES'].get(criteria[0]), filters)
+
+    def search_author(self, criteria, filters=NO_FILTERS):
+        """Книги автора (нормализованное имя criteria[0]) в порядке каталога."""
+        return self.apply_filters(self.facets['AUTHOR'].get(criteria[0]), filters)
+
+    def genre_rank_key(self, criteria):
+        return None
+
+    def series_rank_key(self, criteria):
+        """Порядок уже задан фасетом (по номерам в серии)."""
+        return None
+
+    def author_rank_key(self, criteria):
+        """Книги автора - по сериям и номерам в них, как в последовательном поиске."""
+        return self.fields_rank_key({'AUTHOR': criteria[0]})
+
+    def correct_smart(self, query_parts):
+        """Части запроса умного поиска с исправленными опечатками в словах авторов и серий, или None."""
+        deadline = time.monotonic() + FUZZY_SEARCH_TIMEOUT
+        search_keys = self.search_keys
+
+        def exists(word):
+            return any(word in search_keys[index] for index in self.search_index.candidates([word]))
+        corrected = correct_words(' '.join(query_parts), list(self.fuzzy_indexes.values()), exists, deadline)
+        return corrected.split() if corrected else None
+
+    def correct_fields(self, criteria):
+        """Критерии последовательного поиска с исправленными автором и серией, или None."""
+        deadline = time.monotonic() + FUZZY_SEARCH_TIMEOUT
+        corrected = dict(criteria)
+        for field, tree in self.fuzzy_indexes.items():
+            if criteria.get(field):
+                field_index = self.field_indexes[field]
+                fixed = correct_words(criteria[field], [tree], lambda word: bool(field_index.matching(word)), deadline)
+                if fixed:
+                    corrected[field] = fixed
+        return corrected if corrected != criteria else None
+
+    def field_candidates(self, criteria):
+        """
+        Планировщик последовательного поиска. criteria - {поле: нормализованная подстрока}.
+        Оценивает селективность каждого критерия по индексам, начинает с самого
+        избирательного и пересекает с ним следующие, пока их множества не слишком велики.
+        Возвращает отсортированный список записей-кандидатов или None (нужен полный просмотр).
+        Кандидаты - надмножество результата: точная проверка остаётся за вызывающим.
+        """
+        plan = []
+        for field, needle in criteria.items():
+            if not needle:
+                continue
+            if field in self.field_indexes:
+                codes = self.field_indexes[field].matching(needle)
+                plan.append((self.field_indexes[field].estimate(codes), field, codes))
+            else:
+                estimate = self.search_index.estimate([needle])
+                if estimate is not None:
+                    plan.append((estimate, field, None))
+        if not plan:
+            return None
+        plan.sort(key=lambda item: item[0])
+        logger.debug(f"План поиска: {[(field, estimate) for estimate, field, _ in plan]}")
+
+        candidates = None
+        for estimate, field, codes in plan:
+            if candidates is not None and estimate > len(candidates) * PLANNER_INTERSECT_RATIO:
+                break
+            if codes is not None:
+                rows = self.field_indexes[field].rows(codes)
+            else:
+                rows = set(self.search_index.candidates([criteria[field]]))
+            candidates = rows if candidates is None else candidates & rows
+            if not candidates:
+                return []
+        return sorted(candidates)
+
+    def find(self, field, value):
+        """Возвращает первую запись с точным значением поля (по хеш-индексу) или None."""
+        index = self.indexes.get(field)
+        if index is not None:
+            row = index.get(self.columns[field], value)
+            return BookRecord(self, row) if row is not None else None
+        return next((book for book in self if book[field] == value), None)
+
+    def member_slice(self, name):
+        """Возвращает частичный каталог с записями одного INP-файла."""
+        start, end, _ = self.members[name]
+        return self.slice(start, end)
+
+    def freeze(self):
+        """Завершает построение каталога."""
+        for column in self.columns.values():
+            column.freeze()
+        return self
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return BookRecord(self, index)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield BookRecord(self, index)
+
+    def iter_book_files(self):
+        """Перебирает (архив, имя файла в архиве, LIBID) всех записей каталога."""
+        archives, files, exts, libids = (self.columns[field] for field in ('INP_ARCHIVE_NAME', 'FILE', 'EXT', 'LIBID'))
+        for index in range(self.count):
+            yield archives[index], f"{files[index]}.{exts[index]}", libids[index]
+
+    def memory_usage(self):
+        """Возвращает оценку памяти каталога по колонкам и индексам (в байтах)."""
+        usage = {field: column.nbytes() for field, column in self.columns.items()}
+        usage.update((f"индекс {field}", index.nbytes()) for field, index in self.indexes.items())
+        usage["ключи поиска"] = self.search_keys.nbytes()
+        usage["ключи транслитерации"] = self.translit_keys.nbytes()
+        usage["индекс триграмм"] = self.search_index.nbytes()
+        usage.update((f"индекс поля {field}", index.nbytes()) for field, index in self.field_indexes.items())
+        usage.update((f"фильтр {field}", index.nbytes()) for field, index in self.filters.items())
+        usage.update((f"BK-дерево {field}", tree.nbytes()) for field, tree in self.fuzzy_indexes.items())
+        if 'GENRE' in self.facets:
+            usage["фасет GENRE"] = self.facets['GENRE'].nbytes()
+        return usage
+
+    def memory_report(self):
+        """Строка с объёмом каталога и средним числом байт на книгу."""
+        total = sum(self.memory_usage().values())
+        per_book = total / self.count if self.count else 0
+        return f"Каталог: {self.count} книг, {total / (1024 * 1024):.1f} МБ, {per_book:.0f} байт на книгу"
+
+
+# =================================================================
+# КАТАЛОГ В SQLITE (FTS5) ДЛЯ ХОСТОВ С МАЛЫМ ОБЪЁМОМ ПАМЯТИ
+# =================================================================
+
+class SqliteColumn:
+    """Колонка каталога SQLite: значения читаются с диска через кэш строк."""
+
+    def __init__(self, catalog, field):
+        # Слабая ссылка: без цикла каталог освобождается (и закрывается) сразу, как только он не нужен
+        self.catalog = weakref.proxy(catalog)
+        self.position = CATALOG_FIELDS.index(field)
+
+    def __getitem__(self, index):
+        return self.catalog.row(index)[self.position]
+
+
+class SqliteCatalog:
+    """
+    Каталог, хранящийся в SQLite: таблица books с исходными полями и нормализованными
+    ключами поиска и внешняя таблица FTS5 с триграммным токенизатором над ключами.
+    Память процесса не зависит от размера библиотеки - данные читает ОС через кэш страниц.
+    Интерфейс совпадает с BookCatalog: записи доступны как BookRecord по номеру строки.
+    """
+    ROW_CACHE_SIZE = 1024
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # После обновления каталога старая база (уже замещённая на диске) закрывается,
+        # когда на каталог не остаётся ссылок - все курсоры поиска переключились на новый
+        self._finalizer = weakref.finalize(self, self.conn.close)
+        self.lock = threading.Lock()
+        self.columns = {field: SqliteColumn(self, field) for field in CATALOG_FIELDS}
+        self.version = 0
+        self.members = {}
+        self._row_cache = OrderedDict()
+        self.count = self._query('SELECT COUNT(*) FROM books')[0][0]
+        for name, start, end, crc, size in self._query('SELECT name, start, end, crc, size FROM members'):
+            self.members[name] = (start, end, (crc, size))
+        # Деревья для исправления опечаток строятся в фоне; пока их нет, исправление не выполняется
+        self.fuzzy_indexes = {}
+        threading.Thread(target=self._build_fuzzy_indexes, daemon=True).start()
+
+    def _build_fuzzy_indexes(self):
+        started = time.monotonic()
+        indexes = {}
+        for field in FUZZY_FIELDS:
+            if self.version and books_data is not self:
+                # Каталог уже заменён новым, у которого свои деревья
+                return
+            values = [row[0] for row in self._query(f'SELECT DISTINCT key_{field.lower()} FROM books')]
+            indexes[field] = BKTree.from_values(values)
+        self.fuzzy_indexes = indexes
+        logger.info(f"Индекс для исправления опечаток построен за {time.monotonic() - started:.2f} с.")
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def row(self, index):
+        """Возвращает все поля записи (с небольшим LRU-кэшем строк)."""
+        with self.lock:
+            row = self._row_cache.get(index)
+            if row is not None:
+                self._row_cache.move_to_end(index)
+                return row
+            row = self.conn.execute(f'SELECT {SQLITE_BOOK_COLUMNS} FROM books WHERE id = ?', (index,)).fetchone()
+            if row is None:
+                raise IndexError(index)
+            self._row_cache[index] = row
+            if len(self._row_cache) > self.ROW_CACHE_SIZE:
+                self._row_cache.popitem(last=False)
+            return row
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return BookRecord(self, index)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield BookRecord(self, index)
+
+    def iter_book_files(self):
+        """Перебирает (архив, имя файла в архиве, LIBID) всех записей каталога."""
+        # Отдельное соединение, чтобы долгий перебор не блокировал поиск
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for archive_name, file_name, ext, libid in conn.execute(
+                    'SELECT inp_archive_name, file, ext, libid FROM books ORDER BY id'):
+                yield archive_name, f"{file_name}.{ext}", libid
+        finally:
+            conn.close()
+
+    def find(self, field, value):
+        """Возвращает первую запись с точным значением поля (по индексу SQLite) или None."""
+        column = field.lower()
+        if field not in CATALOG_FIELDS:
+            return None
+        rows = self._query(f'SELECT id FROM books WHERE {column} = ? ORDER BY id LIMIT 1', (value,))
+        return BookRecord(self, rows[0][0]) if rows else None
+
+    def _search(self, fts_terms, conditions, params, rank_sql, rank_params, series_column='key_series'):
+        """
+        Выполняет поиск: FTS5-фраза для частей от 3 символов, instr() для остальных условий.
+        Ранжирование (rank_sql) выполняет сам SQLite, номера возвращаются уже упорядоченными.
+        """
+        sql = 'SELECT b.id FROM books b'
+        if fts_terms:
+            sql += ' JOIN books_fts ON books_fts.rowid = b.id'
+            conditions = ['books_fts MATCH ?'] + conditions
+            params = [' AND '.join(fts_terms)] + params
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += (f" ORDER BY {rank_sql + ', ' if rank_sql else ''}"
+                f"b.{series_column} = '', b.{series_column}, b.serno_sort, b.id")
+        return [row[0] for row in self._query(sql, list(params) + list(rank_params))]
+
+    def search_smart(self, query_parts, filters=NO_FILTERS):
+        """Умный поиск (та же семантика и тот же порядок, что и у BookCatalog)."""
+        author, title, series, serno = sqlite_key_columns(False)
+        columns = f"{{{author} {title} {series} {serno}}}"
+        fts_terms = [f"{columns} : {fts_phrase(part)}" for part in query_parts if len(part) >= TrigramIndex.GRAM]
+        short_parts = [part for part in query_parts if len(part) < TrigramIndex.GRAM]
+        key = f"b.{author} || char(10) || b.{title} || char(10) || b.{series} || char(10) || b.{serno}"
+        primary_hits = ' + '.join([f'(instr(b.{author}, ?) > 0 OR instr(b.{title}, ?) > 0)'] * len(query_parts))
+        rank_sql = f"? IN (b.{author}, b.{title}, b.{series}) DESC"
+        if primary_hits:
+            rank_sql += f", ({primary_hits}) DESC"
+        rank_params = [' '.join(query_parts)] + [part for part in query_parts for _ in range(2)]
+        conditions, params = sqlite_filter_conditions(filters)
+        return self._search(fts_terms, [f'instr({key}, ?) > 0'] * len(short_parts) + conditions,
+                            short_parts + params, rank_sql, rank_params, series)
+
+    def search_translit(self, query_pairs, filters=NO_FILTERS):
+        """
+        Поиск с транслитерацией (та же семантика и тот же порядок, что и у BookCatalog):
+        часть запроса ищется в колонках key_*, её транслитерация - в колонках tkey_*.
+        """
+        plain, translit = sqlite_key_columns(False), sqlite_key_columns(True)
+        plain_columns, translit_columns = f"{{{' '.join(plain)}}}", f"{{{' '.join(translit)}}}"
+        plain_key = ' || char(10) || '.join(f'b.{column}' for column in plain)
+        translit_key = ' || char(10) || '.join(f'b.{column}' for column in translit)
+        fts_terms, conditions, params = [], [], []
+        primary_hits, rank_params = [], []
+        for part, translit_part in query_pairs:
+            if len(part) >= TrigramIndex.GRAM and len(translit_part) >= TrigramIndex.GRAM:
+                fts_terms.append(f"({plain_columns} : {fts_phrase(part)} OR {translit_columns} : {fts_phrase(translit_part)})")
+            elif len(part) >= TrigramIndex.GRAM and not translit_part:
+                fts_terms.append(f"{plain_columns} : {fts_phrase(part)}")
+            elif translit_part:
+                conditions.append(f'(instr({plain_key}, ?) > 0 OR instr({translit_key}, ?) > 0)')
+                params.extend([part, translit_part])
+            else:
+                conditions.append(f'instr({plain_key}, ?) > 0')
+                params.append(part)
+            hits = [f'instr(b.{plain[0]}, ?) > 0', f'instr(b.{plain[1]}, ?) > 0']
+            rank_params.extend([part, part])
+            if translit_part:
+                hits += [f'instr(b.{translit[0]}, ?) > 0', f'instr(b.{translit[1]}, ?) > 0']
+                rank_params.extend([translit_part, translit_part])
+            primary_hits.append(f"({' OR '.join(hits)})")
+        exact = f"? IN (b.{plain[0]}, b.{plain[1]}, b.{plain[2]})"
+        exact_params = [' '.join(part for part, _ in query_pairs)]
+        translit_phrase = ' '.join(translit_part for _, translit_part in query_pairs if translit_part)
+        if translit_phrase:
+            exact += f" OR ? IN (b.{translit[0]}, b.{translit[1]}, b.{translit[2]})"
+            exact_params.append(translit_phrase)
+        rank_sql = f"({exact}) DESC"
+        if primary_hits:
+            rank_sql += f", ({' + '.join(primary_hits)}) DESC"
+        filter_conditions, filter_params = sqlite_filter_conditions(filters)
+        return self._search(fts_terms, conditions + filter_conditions, params + filter_params,
+                            rank_sql, exact_params + rank_params)
+
+    def _exists(self, fts_query):
+        return bool(self._query('SELECT 1 FROM books_fts WHERE books_fts MATCH ? LIMIT 1', (fts_query,)))
+
+    def correct_smart(self, query_parts):
+        """Исправление опечаток (та же семантика, что и у BookCatalog.correct_smart)."""
+        deadline = time.monotonic() + FUZZY_SEARCH_TIMEOUT
+        columns = f"{{{' '.join(sqlite_key_columns(False))}}}"
+        corrected = correct_words(' '.join(query_parts), list(self.fuzzy_indexes.values()),
+                                  lambda word: self._exists(f"{columns} : {fts_phrase(word)}"), deadline)
+        return corrected.split() if corrected else None
+
+    def correct_fields(self, criteria):
+        deadline = time.monotonic() + FUZZY_SEARCH_TIMEOUT
+        corrected = dict(criteria)
+        for field, tree in self.fuzzy_indexes.items():
+            if criteria.get(field):
+                column = f"key_{field.lower()}"
+                fixed = correct_words(criteria[field], [tree],
+                                      lambda word: self._exists(f"{column} : {fts_phrase(word)}"), deadline)
+                if fixed:
+                    corrected[field] = fixed
+        return corrected if corrected != criteria else None
+
+    def smart_rank_key(self, query_parts):
+        """Порядок уже задан в SQL - дополнительное ранжирование не требуется."""
+        return None
+
+    def fields_rank_key(self, criteria):
+        return None
+
+    def translit_rank_key(self, query_parts):
+        return None
+
+    def genre_counts(self, filters=NO_FILTERS):
+        """Число книг по каждому коду жанра: без фильтров - из таблицы genres, заполненной при импорте."""
+        conditions, params = sqlite_filter_conditions(filters)
+        if not conditions:
+            return dict(self._query('SELECT code, count FROM genres'))
+        sql = (f"SELECT g.genre, COUNT(*) FROM book_genres g JOIN books b ON b.id = g.id "
+               f"WHERE {' AND '.join(conditions)} GROUP BY g.genre")
+        return dict(self._query(sql, params))
+
+    def facet_count(self, field, value, filters=NO_FILTERS):
+        conditions, params = sqlite_filter_conditions(filters)
+        sql = f"SELECT COUNT(*) FROM books b WHERE {' AND '.join([f'b.key_{field.lower()} = ?'] + conditions)}"
+        return self._query(sql, [value] + params)[0][0]
+
+    def _facet_search(self, join, condition, value, filters, order):
+        conditions, params = sqlite_filter_conditions(filters)
+        sql = f"SELECT b.id FROM books b {join} WHERE {' AND '.join([condition] + conditions)} ORDER BY {order}"
+        return [row[0] for row in self._query(sql, [value] + params)]
+
+    def search_genre(self, criteria, filters=NO_FILTERS):
+        return self._facet_search('JOIN book_genres g ON g.id = b.id', 'g.genre = ?', criteria[0], filters, 'b.id')
+
+    def search_series(self, criteria, filters=NO_FILTERS):
+        return self._facet_search('', 'b.key_series = ?', criteria[0], filters, 'b.serno_sort, b.id')
+
+    def search_author(self, criteria, filters=NO_FILTERS):
+        return self._facet_search('', 'b.key_author = ?', criteria[0], filters,
+                                  "b.key_series = '', b.key_series, b.serno_sort, b.id")
+
+    def genre_rank_key(self, criteria):
+        return None
+
+    def series_rank_key(self, criteria):
+        return None
+
+    def author_rank_key(self, criteria):
+        return None
+
+    def search_fields(self, criteria, filters=NO_FILTERS):
+        """Последовательный поиск (та же семантика, что и у BookCatalog.search_fields)."""
+        fts_terms = []
+        conditions, params = sqlite_filter_conditions(filters)
+        for field, needle in criteria.items():
+            if not needle:
+                continue
+            if field in SEARCH_KEY_FIELDS:
+                column = f"key_{field.lower()}"
+                if len(needle) >= TrigramIndex.GRAM:
+                    fts_terms.append(f"{column} : {fts_phrase(needle)}")
+                else:
+                    conditions.append(f'instr(b.{column}, ?) > 0')
+                    params.append(needle)
+            else:
+                conditions.append(f'instr(b.{field.lower()}, ?) > 0')
+                params.append(needle)
+        weights = {'AUTHOR': 2, 'TITLE': 2}
+        exact = [(f"{weights.get(field, 1)} * (b.key_{field.lower()} = ?)", needle)
+                 for field, needle in criteria.items() if needle and field in SEARCH_KEY_FIELDS]
+        rank_sql = f"({' + '.join(expr for expr, _ in exact)}) DESC" if exact else ''
+        return self._search(fts_terms, conditions, params, rank_sql, [needle for _, needle in exact])
+
+    def filter_values(self, field, limit):
+        """Самые частые значения поля фильтра (для кнопок выбора)."""
+        if field not in FILTER_FIELDS:
+            return []
+        column = field.lower()
+        rows = self._query(f"SELECT lower(trim({column})) AS value, COUNT(*) FROM books WHERE value != '' "
+                           f"GROUP BY value ORDER BY COUNT(*) DESC LIMIT ?", (limit,))
+        return [value for value, _ in rows]
+
+    def memory_usage(self):
+        return {"файл базы каталога": os.path.getsize(self.db_path)}
+
+    def memory_report(self):
+        size = os.path.getsize(self.db_path)
+        per_book = size / self.count if self.count else 0
+        return (f"Каталог (SQLite): {self.count} книг, {size / (1024 * 1024):.1f} МБ на диске, "
+                f"{per_book:.0f} байт на книгу")
+
+    def close(self):
+        with self.lock:
+            self._finalizer()
+
+
+def sqlite_key_columns(translit):
+    """Колонки ключа поиска в порядке SEARCH_KEY_FIELDS: обычные key_* или транслитерированные tkey_*."""
+    return [f"{'tkey' if translit and field in TRANSLIT_KEY_FIELDS else 'key'}_{field.lower()}"
+            for field in SEARCH_KEY_FIELDS]
+
+
+def sqlite_filter_conditions(filters):
+    """Условия WHERE и параметры для фильтров поиска (скрывать удалённые, языки, форматы)."""
+    hide_deleted, languages, formats = filters
+    conditions, params = [], []
+    if hide_deleted:
+        conditions.append("trim(b.del) != '1'")
+    for column, values in (('lang', languages), ('ext', formats)):
+        if values:
+            conditions.append(f"lower(trim(b.{column})) IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    return conditions, params
+
+
+def fts_phrase(text):
+    """Экранирует строку как фразу запроса FTS5."""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def build_sqlite_catalog(inpx_path, db_path, signature):
+    """
+    Импортирует INPX в новую базу SQLite (по одному INP-файлу за раз, чтобы не держать
+    весь каталог в памяти) и атомарно заменяет ею db_path.
+    """
+    temp_path = f"{db_path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    with zipfile.ZipFile(inpx_path, 'r') as archive:
+        inp_files = [f for f in archive.namelist() if f.lower().endswith('.inp')]
+    if not inp_files:
+        logger.error("Ошибка: В INPX-архиве не найдено ни одного .inp файла.")
+        return False
+
+    conn = sqlite3.connect(temp_path)
+    key_names = [f"key_{field.lower()}" for field in SEARCH_KEY_FIELDS] + [f"tkey_{field.lower()}" for field in TRANSLIT_KEY_FIELDS]
+    key_columns = ', '.join(f"{name} TEXT" for name in key_names)
+    conn.executescript(f'''
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE members (name TEXT PRIMARY KEY, start INTEGER, end INTEGER, crc INTEGER, size INTEGER);
+        CREATE TABLE book_genres (genre TEXT, id INTEGER);
+        CREATE TABLE books (
+            id INTEGER PRIMARY KEY,
+            {', '.join(f"{field.lower()} TEXT" for field in CATALOG_FIELDS)},
+            {key_columns},
+            serno_sort REAL
+        );
+        CREATE VIRTUAL TABLE books_fts USING fts5(
+            {', '.join(key_names)},
+            content='books', content_rowid='id', tokenize='trigram case_sensitive 1'
+        );
+    ''')
+    placeholders = ', '.join('?' * (1 + len(CATALOG_FIELDS) + len(key_names) + 1))
+    insert_sql = (f"INSERT INTO books (id, {SQLITE_BOOK_COLUMNS}, {', '.join(key_names)}, serno_sort) "
+                  f"VALUES ({placeholders})")
+    count = 0
+    for inp_file_name in inp_files:
+        part, elapsed = parse_inp_member(inpx_path, inp_file_name)
+        logger.info(f"INP-файл '{inp_file_name}': {len(part)} книг за {elapsed:.2f} с.")
+        rows = []
+        for book in part:
+            key = smart_search_key(book)
+            translit_key = translit_text(key).split('\n')
+            translit_values = [translit_key[SEARCH_KEY_FIELDS.index(field)] for field in TRANSLIT_KEY_FIELDS]
+            sort_key = part.serno_sort_key(book.index)
+            rows.append((count + book.index, *(book[field] for field in CATALOG_FIELDS), *key.split('\n'),
+                         *translit_values, sort_key if sort_key != float('inf') else 1e300))
+        conn.executemany(insert_sql, rows)
+        conn.executemany('INSERT INTO book_genres (genre, id) VALUES (?, ?)',
+                         [(genre, count + book.index) for book in part for genre in book['GENRE'].split(':') if genre])
+        for name, (start, end, (crc, size)) in part.members.items():
+            conn.execute('INSERT INTO members (name, start, end, crc, size) VALUES (?, ?, ?, ?, ?)',
+                         (name, count + start, count + end, crc, size))
+        count += len(part)
+    conn.executescript('''
+        CREATE INDEX books_libid ON books (libid, id);
+        CREATE INDEX books_file ON books (file, id);
+        CREATE INDEX books_serno_sort ON books (serno_sort, id);
+        CREATE INDEX books_series ON books (key_series, serno_sort, id);
+        CREATE INDEX books_author ON books (key_author);
+        CREATE INDEX book_genres_genre ON book_genres (genre, id);
+        CREATE TABLE genres AS SELECT genre AS code, COUNT(*) AS count FROM book_genres GROUP BY genre;
+        INSERT INTO books_fts (books_fts) VALUES ('rebuild');
+    ''')
+    conn.execute('INSERT INTO meta (key, value) VALUES (?, ?)', ('signature', json.dumps(signature)))
+    conn.execute('INSERT INTO meta (key, value) VALUES (?, ?)', ('version', str(CATALOG_SNAPSHOT_VERSION)))
+    conn.commit()
+    conn.close()
+    os.replace(temp_path, db_path)
+    logger.info(f"Каталог SQLite построен: {count} книг.")
+    return True
+
+
+def open_sqlite_catalog(inpx_path, signature):
+    """Открывает каталог SQLite, при необходимости (пере)импортируя INPX."""
+    if os.path.exists(CATALOG_DB_FILE):
+        try:
+            conn = sqlite3.connect(CATALOG_DB_FILE)
+            stored = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+            conn.close()
+            # Версия формата - как у снимка каталога: при изменении схемы база пересоздаётся
+            if (stored.get('version') == str(CATALOG_SNAPSHOT_VERSION)
+                    and json.loads(stored.get('signature', 'null')) == signature):
+                return SqliteCatalog(CATALOG_DB_FILE)
+            logger.info("База каталога SQLite устарела, выполняем импорт INPX.")
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"База каталога SQLite повреждена и будет пересоздана: {e}")
+    if not build_sqlite_catalog(inpx_path, CATALOG_DB_FILE, signature):
+        return None
+    return SqliteCatalog(CATALOG_DB_FILE)
+
+
+# =================================================================
+# ОБЩИЙ КЭШ РЕЗУЛЬТАТОВ ПОИСКА
+# =================================================================
+
+class QueryCache:
+    """
+    Общий для всех пользователей LRU-кэш результатов поиска со сроком жизни записей.
+    Ключ - режим поиска и нормализованный запрос, значение - массив номеров записей.
+    Записи привязаны к версии каталога и не выдаются после его обновления.
+    Размер ограничен числом запросов и суммарным числом хранимых номеров.
+    """
+
+    def __init__(self, max_entries, max_rows, ttl):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry_version, created, rows = entry
+                if entry_version == version and time.monotonic() - created <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return rows
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, version, rows):
+        if self.max_entries <= 0 or len(rows) > self.max_rows:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (version, time.monotonic(), rows)
+            self.rows += len(rows)
+            while len(self.entries) > self.max_entries or self.rows > self.max_rows:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, _, rows = self.entries.pop(key)
+        self.rows -= len(rows)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.rows = 0
+
+    def report(self):
+        with self.lock:
+            total = self.hits + self.misses
+            hit_rate = self.hits / total * 100 if total else 0
+            return (f"Кэш поиска: {len(self.entries)} запросов, {self.rows * 4 / 1024:.0f} КБ, "
+                    f"попаданий {self.hits}, промахов {self.misses} ({hit_rate:.0f}% попаданий)")
+
+
+# =================================================================
+# ПУЛ ОТКРЫТЫХ АРХИВОВ С КНИГАМИ
+# =================================================================
+
+def archive_signature(archive_path):
+    """Подпись архива на диске: время модификации и размер."""
+    stat = os.stat(archive_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ArchivePool:
+    """
+    LRU-пул открытых ZIP-архивов с книгами. Оглавление архива разбирается один раз
+    при открытии, и повторные скачивания из того же архива его не перечитывают.
+    Архив открывается заново, если у файла изменились время модификации или размер.
+    Вытесненный архив закрывается, но уже открытые из него книги дочитываются.
+    """
+
+    def __init__(self, max_archives):
+        self.max_archives = max_archives
+        self.archives = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def open(self, archive_path, member_name):
+        """Открывает файл member_name из архива archive_path на чтение."""
+        signature = archive_signature(archive_path)
+        with self.lock:
+            entry = self.archives.get(archive_path)
+            if entry is not None and entry[0] == signature:
+                self.archives.move_to_end(archive_path)
+                self.hits += 1
+                return entry[1].open(member_name)
+            self.misses += 1
+
+        # Разбор оглавления большого архива - долгая операция, делаем её без блокировки
+        archive = zipfile.ZipFile(archive_path, 'r')
+        if self.max_archives <= 0:
+            with archive:
+                return archive.open(member_name)
+        with self.lock:
+            entry = self.archives.get(archive_path)
+            if entry is not None and entry[0] == signature:
+                # Пока мы открывали архив, это успел сделать другой поток
+                archive.close()
+                archive = entry[1]
+            else:
+                if entry is not None:
+                    entry[1].close()
+                self.archives[archive_path] = (signature, archive)
+                while len(self.archives) > self.max_archives:
+                    _, (_, evicted) = self.archives.popitem(last=False)
+                    evicted.close()
+            self.archives.move_to_end(archive_path)
+            return archive.open(member_name)
+
+    def clear(self):
+        with self.lock:
+            for _, archive in self.archives.values():
+                archive.close()
+            self.archives.clear()
+
+    def report(self):
+        with self.lock:
+            total = self.hits + self.misses
+            hit_rate = self.hits / total * 100 if total else 0
+            return (f"Пул архивов: открыто {len(self.archives)} из {self.max_archives}, "
+                    f"попаданий {self.hits}, промахов {self.misses} ({hit_rate:.0f}% попаданий)")
+
+
+# =================================================================
+# ИНДЕКС ФАЙЛОВ КНИГ В АРХИВАХ
+# =================================================================
+
+class ArchiveMembers:
+    """
+    Таблица файлов одного ZIP-архива, отсортированная по имени: смещение сжатых
+    данных (сразу за локальным заголовком), сжатый и исходный размер, метод сжатия и CRC.
+    signature - время модификации и размер архива, для которых таблица построена.
+    """
+    __slots__ = ('signature', 'names', 'offsets', 'compressed_sizes', 'sizes', 'methods', 'crcs')
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.names = []
+        self.offsets = array('q')
+        self.compressed_sizes = array('q')
+        self.sizes = array('q')
+        self.methods = array('H')
+        self.crcs = array('I')
+
+    @classmethod
+    def scan(cls, archive_path, signature):
+        """Читает оглавление архива и локальные заголовки всех его файлов."""
+        members = cls(signature)
+        with zipfile.ZipFile(archive_path, 'r') as archive, open(archive_path, 'rb') as f:
+            for info in sorted(archive.infolist(), key=lambda info: info.filename):
+                if info.is_dir():
+                    continue
+                f.seek(info.header_offset)
+                header = f.read(ZIP_LOCAL_HEADER_SIZE)
+                if len(header) != ZIP_LOCAL_HEADER_SIZE or header[:4] != zipfile.stringFileHeader:
+                    raise zipfile.BadZipFile(f"Неверный локальный заголовок файла {info.filename}")
+                name_length, extra_length = struct.unpack('<HH', header[26:30])
+                members.names.append(info.filename)
+                members.offsets.append(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length)
+                members.compressed_sizes.append(info.compress_size)
+                members.sizes.append(info.file_size)
+                # Зашифрованные файлы читаем только через zipfile
+                members.methods.append(0xFFFF if info.flag_bits & 0x1 else info.compress_type)
+                members.crcs.append(info.CRC)
+        return members
+
+    def find(self, member_name):
+        position = bisect_left(self.names, member_name)
+        if position < len(self.names) and self.names[position] == member_name:
+            return position
+        return None
+
+    def __len__(self):
+        return len(self.names)
+
+
+class MemberIndex:
+    """
+    Индекс файлов книг во всех архивах BOOKS_DIR/lib.rus.ec, сохраняемый рядом со снимком
+    каталога. Книга извлекается чтением сжатых байт по известному смещению (os.pread)
+    и распаковкой zlib без разбора оглавления ZIP. Если архив изменился после
+    построения индекса или файл в нём не найден, чтение выполняется через ArchivePool.
+    """
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.archives = {}
+        self.missing_archives = 0
+        self.missing_books = 0
+        self.refresh_lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(MEMBER_INDEX_FILE):
+            return
+        try:
+            with open(MEMBER_INDEX_FILE, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Индекс файлов в архивах поврежден и будет пересоздан: {e}")
+            return
+        if snapshot.get('version') == MEMBER_INDEX_VERSION and snapshot.get('archive_dir') == self.archive_dir:
+            self.archives = snapshot['archives']
+
+    def save(self):
+        temp_path = f"{MEMBER_INDEX_FILE}.tmp"
+        try:
+            os.makedirs(os.path.dirname(MEMBER_INDEX_FILE), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                pickle.dump({'version': MEMBER_INDEX_VERSION, 'archive_dir': self.archive_dir, 'archives': self.archives},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, MEMBER_INDEX_FILE)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить индекс файлов в архивах: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def refresh(self):
+        """
+        Перестраивает таблицы новых и изменившихся архивов, удаляет исчезнувшие.
+        Возвращает число перечитанных архивов.
+        """
+        try:
+            archive_names = sorted(name for name in os.listdir(self.archive_dir) if name.lower().endswith('.zip'))
+        except FileNotFoundError:
+            logger.error(f"Папка с архивами книг не найдена: {self.archive_dir}")
+            archive_names = []
+        archives = {}
+        rescanned = 0
+        for archive_name in archive_names:
+            archive_path = os.path.join(self.archive_dir, archive_name)
+            try:
+                signature = archive_signature(archive_path)
+                members = self.archives.get(archive_name)
+                if members is None or members.signature != signature:
+                    members = ArchiveMembers.scan(archive_path, signature)
+                    rescanned += 1
+                archives[archive_name] = members
+            except (OSError, zipfile.BadZipFile) as e:
+                logger.error(f"Не удалось проиндексировать архив '{archive_name}': {e}")
+        changed = rescanned or archives.keys() != self.archives.keys()
+        self.archives = archives
+        if changed:
+            self.save()
+        return rescanned
+
+    def verify(self, catalog):
+        """Проверяет, что для каждой записи каталога есть архив и файл в нём."""
+        missing_archives = set()
+        missing_books = 0
+        examples = []
+        for archive_name, member_name, libid in catalog.iter_book_files():
+            members = self.archives.get(archive_name)
+            if members is None:
+                missing_archives.add(archive_name)
+            elif members.find(member_name) is not None:
+                continue
+            missing_books += 1
+            if len(examples) < MISSING_BOOKS_LOG_LIMIT:
+                examples.append(f"LIBID {libid}: {archive_name}/{member_name}")
+        self.missing_archives = len(missing_archives)
+        self.missing_books = missing_books
+        if missing_books:
+            logger.warning(f"В архивах отсутствуют файлы {missing_books} книг каталога "
+                           f"(нет архивов: {len(missing_archives)}). Например: {'; '.join(examples)}")
+
+    def copy(self, archive_name, member_name, out):
+        """
+        Распаковывает файл из архива в поток out по индексу.
+        Возвращает False, если воспользоваться индексом нельзя.
+        """
+        members = self.archives.get(archive_name)
+        position = members.find(member_name) if members is not None else None
+        if position is None or members.methods[position] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return False
+        archive_path = os.path.join(self.archive_dir, archive_name)
+        if archive_signature(archive_path) != members.signature:
+            return False
+
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if members.methods[position] == zipfile.ZIP_DEFLATED else None
+        offset = members.offsets[position]
+        remaining = members.compressed_sizes[position]
+        crc = 0
+        size = 0
+        fd = os.open(archive_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            while remaining:
+                chunk = os.pread(fd, min(remaining, STREAM_CHUNK_SIZE), offset)
+                if not chunk:
+                    raise zipfile.BadZipFile(f"Архив '{archive_name}' обрезан")
+                offset += len(chunk)
+                remaining -= len(chunk)
+                data = decompressor.decompress(chunk) if decompressor else chunk
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                out.write(data)
+            if decompressor:
+                data = decompressor.flush()
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                out.write(data)
+        finally:
+            os.close(fd)
+        if crc != members.crcs[position] or size != members.sizes[position]:
+            raise zipfile.BadZipFile(f"Контрольная сумма файла '{member_name}' в архиве '{archive_name}' не совпадает")
+        return True
+
+    def report(self):
+        files = sum(len(members) for members in self.archives.values())
+        return (f"Индекс архивов: {len(self.archives)} архивов, {files} файлов, "
+                f"нет файлов для {self.missing_books} книг (нет архивов: {self.missing_archives})")
+
+
+def refresh_member_index():
+    """Обновляет индекс файлов в архивах и сверяет с ним текущий каталог (в фоновом потоке)."""
+    if not hasattr(os, 'pread'):
+        return
+    if not member_index.refresh_lock.acquire(blocking=False):
+        return
+    try:
+        started = time.monotonic()
+        if not member_index.archives:
+            member_index.load()
+        rescanned = member_index.refresh()
+        member_index.verify(books_data)
+        logger.info(f"Индекс файлов в архивах обновлен за {time.monotonic() - started:.2f} с "
+                    f"(перечитано архивов: {rescanned}). {member_index.report()}")
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении индекса файлов в архивах: {e}", exc_info=True)
+    finally:
+        member_index.refresh_lock.release()
+
 
 # Глобальные переменные для хранения данных
-books_data = []
-# Словарь для хранения результатов поиска и текущей страницы для каждого пользователя
+books_data = BookCatalog()
+# Словарь для хранения курсоров поиска (SearchCursor) и текущей страницы для каждого пользователя
 user_search_results = {}
 user_data = {}
 # Теперь registered_users будет словарем с полной информацией о пользователях
@@ -64,9 +1902,24 @@ registered_users = {}
 pending_users = {}
 is_processing_link = {}
 user_state = {}
+# Блокировка, не позволяющая запустить два обновления каталога одновременно
+catalog_reload_lock = threading.Lock()
+# Счётчик версий каталога: каждая подмена books_data получает новую версию
+catalog_versions = count(1)
+# Размер и время изменения INPX на момент загрузки каталога при старте - от них отсчитывает фоновая проверка
+loaded_inpx_stat = None
+query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_MAX_ROWS, QUERY_CACHE_TTL)
+archive_pool = ArchivePool(ARCHIVE_POOL_SIZE)
+member_index = MemberIndex(os.path.join(BOOKS_DIR, 'lib.rus.ec'))
 
 # Настройки для пагинации
 results_per_page = 10
+# Сколько страниц результатов ранжируется заранее (остальные - при листании)
+RANKED_PAGES_AHEAD = 5
+# Сколько самых частых языков и форматов предлагать в настройке фильтров
+FILTER_BUTTONS = 8
+# Сколько кнопок "Все книги серии" показывать на странице результатов
+FACET_BUTTONS = 3
 
 # Инициализация бота
 bot = telebot.TeleBot(BOT_TOKEN)
@@ -90,32 +1943,362 @@ logger = logging.getLogger(__name__)
 # ФУНКЦИИ ДЛЯ РАБОТЫ С БАЗОЙ ДАННЫХ
 # =================================================================
 
+class ReaderStats:
+    """Счётчики чтения страниц читалки: сколько байт и страниц SQLite читается и сколько длится распаковка."""
+
+    def __init__(self):
+        self.pages = 0
+        self.bytes_read = 0
+        self.db_pages = 0
+        self.decompress_time = 0.0
+        self.db_page_size = 4096
+        self.lock = threading.Lock()
+
+    def record(self, stored_size, elapsed):
+        with self.lock:
+            self.pages += 1
+            self.bytes_read += stored_size
+            self.db_pages += (stored_size + self.db_page_size - 1) // self.db_page_size
+            self.decompress_time += elapsed
+
+    def report(self):
+        with self.lock:
+            if not self.pages:
+                return "Читалка: страницы еще не открывались"
+            return (f"Читалка: открыто страниц {self.pages}, в среднем прочитано {self.bytes_read / self.pages / 1024:.1f} КБ "
+                    f"({self.db_pages / self.pages:.1f} стр. SQLite) и распаковано за {self.decompress_time / self.pages * 1000:.2f} мс")
+
+
+reader_stats = ReaderStats()
+
+
+class ReadingProgressBuffer:
+    """
+    Отложенная запись прогресса чтения: страница, на которой остановился пользователь,
+    запоминается в памяти, а в базу пишется одной транзакцией раз в interval секунд
+    и при остановке бота. При сбое теряется не больше последних interval секунд листания.
+    При interval <= 0 прогресс пишется сразу.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self.written = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def put(self, user_id, book_id, page):
+        if self.interval <= 0:
+            write_reading_progress([(page, user_id, book_id)])
+            return
+        with self.lock:
+            self.pending[(user_id, book_id)] = page
+
+    def get(self, user_id, book_id):
+        """Страница, ещё не записанная в базу, или None."""
+        with self.lock:
+            return self.pending.get((user_id, book_id))
+
+    def discard(self, user_id, book_id):
+        with self.flush_lock, self.lock:
+            self.pending.pop((user_id, book_id), None)
+
+    def flush(self):
+        """Записывает накопленный прогресс в базу одной транзакцией."""
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            try:
+                write_reading_progress([(page, user_id, book_id) for (user_id, book_id), page in pending.items()])
+            except Exception:
+                # Возвращаем в очередь всё, что не успели перелистать заново
+                with self.lock:
+                    for key, page in pending.items():
+                        self.pending.setdefault(key, page)
+                raise
+            self.written += len(pending)
+            self.batches += 1
+
+    def run(self):
+        """Фоновый поток: раз в interval секунд сбрасывает прогресс в базу."""
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось записать прогресс чтения: {e}")
+
+    def report(self):
+        with self.lock:
+            return (f"Прогресс чтения: ожидают записи {len(self.pending)}, записано {self.written} "
+                    f"за {self.batches} транзакций (интервал {self.interval:g} с)")
+
+
+progress_buffer = ReadingProgressBuffer(PROGRESS_FLUSH_INTERVAL)
+
+# Сколько страниц книги сжимается одним блоком: при листании распаковывается только блок со страницей
+READER_CHUNK_PAGES = 8
+# Чем сжимать тексты книг: zstd, если установлен пакет zstandard, иначе zlib
+READER_CODEC = 'zstd' if zstandard is not None else 'zlib'
+# Уровни сжатия текстов книг
+READER_ZLIB_LEVEL = 6
+READER_ZSTD_LEVEL = 9
+
+# Текст книги хранится один раз на одинаковое содержимое: в book_contents - таблица
+# страниц и способ сжатия, в book_chunks - сжатые блоки по READER_CHUNK_PAGES страниц
+BOOK_CONTENTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS book_contents (
+        content_hash TEXT PRIMARY KEY,
+        page_offsets BLOB,
+        total_pages INTEGER,
+        codec TEXT,
+        content_size INTEGER,
+        stored_size INTEGER
+    )
+'''
+BOOK_CHUNKS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS book_chunks (
+        content_hash TEXT,
+        chunk INTEGER,
+        data BLOB,
+        PRIMARY KEY (content_hash, chunk)
+    )
+'''
+# Прогресс чтения: какую книгу (content_hash в book_contents) и на какой странице читает пользователь
+READING_SESSIONS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS reading_sessions (
+        user_id INTEGER,
+        book_id TEXT,
+        short_id TEXT,
+        book_title TEXT,
+        book_author TEXT,
+        book_series TEXT,
+        series_number INTEGER,
+        content_hash TEXT,
+        current_page INTEGER,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, book_id)
+    )
+'''
+
+READING_SESSIONS_INDEXES = (
+    # Кнопки читалки передают короткий id книги: поиск по нему - точечный запрос по индексу
+    'CREATE INDEX IF NOT EXISTS reading_sessions_short_id ON reading_sessions (user_id, short_id)',
+    'CREATE INDEX IF NOT EXISTS reading_sessions_content ON reading_sessions (content_hash)',
+)
+# Длина короткого id книги в callback_data кнопок читалки
+SHORT_BOOK_ID_LENGTH = 16
+# Сколько подготовленных запросов держит в кэше каждое соединение
+DB_CACHED_STATEMENTS = 256
+# Настройки соединения: WAL (чтение не ждёт записи), synchronous=NORMAL (в WAL не теряет
+# целостность при сбое), кэш страниц 16 МБ, ожидание блокировки до 5 с
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+
+db_connections = threading.local()
+# Все открытые соединения потоков - чтобы закрыть их при остановке бота
+db_connections_all = []
+db_connections_lock = threading.Lock()
+
 def db_connect():
-    """Подключается к базе данных и возвращает соединение."""
-    conn = sqlite3.connect(DB_FILE)
+    """
+    Возвращает постоянное соединение с базой данных для текущего потока:
+    у каждого рабочего потока бота своё соединение, которое не закрывается между запросами.
+    """
+    conn = getattr(db_connections, 'conn', None)
+    if conn is None or db_connections.path != DB_FILE:
+        # Соединение используется только своим потоком, но закрывается при остановке из главного
+        conn = sqlite3.connect(DB_FILE, cached_statements=DB_CACHED_STATEMENTS, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        db_connections.conn = conn
+        db_connections.path = DB_FILE
+        with db_connections_lock:
+            db_connections_all.append(conn)
+    elif conn.in_transaction:
+        # Предыдущая операция в этом потоке завершилась ошибкой, не зафиксировав изменения
+        conn.rollback()
     return conn
 
+def close_db_connections():
+    """
+    Переносит журнал WAL в основной файл базы (PRAGMA wal_checkpoint(TRUNCATE)) и закрывает
+    соединения всех потоков. Вызывается при остановке бота: после этого reader_data.db
+    содержит все данные и не зависит от файлов -wal и -shm.
+    """
+    with db_connections_lock:
+        connections = db_connections_all[:]
+        db_connections_all.clear()
+    if connections:
+        try:
+            busy, _, _ = connections[0].execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+            if busy:
+                logger.warning("Журнал WAL перенесен в базу не полностью: база занята другим соединением.")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при переносе журнала WAL в базу: {e}")
+    for conn in connections:
+        conn.close()
+    logger.info(f"Соединения с базой данных закрыты: {len(connections)}.")
+
+def find_user_book_id(user_id, short_book_id):
+    """Возвращает полный id книги пользователя по короткому id из кнопки или None."""
+    cursor = db_connect().cursor()
+    cursor.execute('SELECT book_id FROM reading_sessions WHERE user_id = ? AND short_id = ?', (user_id, short_book_id))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
 def create_table():
-    """Создает таблицу для хранения данных о книгах, если она не существует."""
+    """Создает таблицы для хранения данных о книгах и настроек пользователей, если они не существуют."""
     conn = db_connect()
     cursor = conn.cursor()
+    # Тексты книг хранятся сжатыми блоками, reading_sessions - только прогресс чтения пользователя
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(book_contents)')]
+    if 'book_content' in columns:
+        migrate_book_contents(conn)
+    cursor.execute(BOOK_CONTENTS_SCHEMA)
+    cursor.execute(BOOK_CHUNKS_SCHEMA)
+    reader_stats.db_page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(reading_sessions)')]
+    if 'book_content' in columns:
+        migrate_reading_sessions(conn, columns)
+    elif columns and 'short_id' not in columns:
+        migrate_reading_sessions_key(conn)
+    cursor.execute(READING_SESSIONS_SCHEMA)
+    for index_sql in READING_SESSIONS_INDEXES:
+        cursor.execute(index_sql)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            user_id INTEGER PRIMARY KEY,
+            hide_deleted INTEGER,
+            languages TEXT,
+            formats TEXT
+        )
+    ''')
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reading_sessions (
-            user_id INTEGER,
-            book_id TEXT PRIMARY KEY,
-            book_title TEXT,
-            book_author TEXT,
-            book_series TEXT,
-            series_number INTEGER,
-            book_content TEXT,
-            current_page INTEGER,
-            total_pages INTEGER,
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            libid TEXT PRIMARY KEY,
+            file_id TEXT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     conn.commit()
-    conn.close()
-    logger.info("Таблица базы данных успешно создана или уже существует.")
+    logger.info("Таблицы базы данных успешно созданы или уже существуют.")
+
+def migrate_reading_sessions(conn, columns):
+    """
+    Переносит базу старого формата, где полный текст книги хранился в каждой строке
+    reading_sessions: тексты переезжают в book_contents (одинаковые - одной строкой),
+    в reading_sessions остаётся только прогресс чтения.
+    """
+    started = time.monotonic()
+    offsets_column = 'page_offsets' if 'page_offsets' in columns else 'NULL'
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    rows = cursor.execute(f'''
+        SELECT user_id, book_id, book_title, book_author, book_series, series_number,
+               book_content, current_page, timestamp, {offsets_column}
+        FROM reading_sessions
+    ''').fetchall()
+    cursor.execute('ALTER TABLE reading_sessions RENAME TO reading_sessions_old')
+    cursor.execute(READING_SESSIONS_SCHEMA)
+    for user_id, book_id, title, author, series, series_number, content, page, timestamp, page_offsets in rows:
+        if page_offsets is None:
+            # Книга сохранена до появления таблицы страниц: размечаем её сейчас
+            content, page_offsets = paginate_book(content or '')
+        else:
+            page_offsets = array('I', page_offsets)
+        content_hash = store_book_content(cursor, content, page_offsets)
+        total_pages = len(page_offsets) // 2
+        cursor.execute('''
+            INSERT INTO reading_sessions
+            (user_id, book_id, short_id, book_title, book_author, book_series, series_number, content_hash, current_page, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, book_id, book_id[:SHORT_BOOK_ID_LENGTH], title, author, series, series_number, content_hash,
+              min(page or 0, max(total_pages - 1, 0)), timestamp))
+    cursor.execute('DROP TABLE reading_sessions_old')
+    conn.commit()
+    # Возвращаем системе место, которое занимали копии текстов
+    conn.execute('VACUUM')
+    logger.info(f"База чтения перенесена в новый формат за {time.monotonic() - started:.2f} с: "
+                f"{len(rows)} книг пользователей.")
+
+def migrate_reading_sessions_key(conn):
+    """
+    Переносит reading_sessions с глобальным ключом book_id на составной ключ
+    (user_id, book_id) с колонкой короткого id для поиска по кнопкам читалки.
+    """
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    cursor.execute('ALTER TABLE reading_sessions RENAME TO reading_sessions_old')
+    cursor.execute(READING_SESSIONS_SCHEMA)
+    cursor.execute(f'''
+        INSERT INTO reading_sessions
+        (user_id, book_id, short_id, book_title, book_author, book_series, series_number, content_hash, current_page, timestamp)
+        SELECT user_id, book_id, substr(book_id, 1, {SHORT_BOOK_ID_LENGTH}), book_title, book_author, book_series, series_number,
+               content_hash, current_page, timestamp
+        FROM reading_sessions_old
+    ''')
+    cursor.execute('DROP TABLE reading_sessions_old')
+    conn.commit()
+    logger.info("Таблица reading_sessions переведена на ключ (user_id, book_id).")
+
+def migrate_book_contents(conn):
+    """Переносит несжатые тексты из book_contents в сжатые блоки book_chunks."""
+    started = time.monotonic()
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    rows = cursor.execute('SELECT book_content, page_offsets FROM book_contents').fetchall()
+    cursor.execute('DROP TABLE book_contents')
+    cursor.execute(BOOK_CONTENTS_SCHEMA)
+    cursor.execute(BOOK_CHUNKS_SCHEMA)
+    for content, page_offsets in rows:
+        store_book_content(cursor, content, array('I', page_offsets))
+    conn.commit()
+    conn.execute('VACUUM')
+    logger.info(f"Тексты книг ({len(rows)}) сжаты за {time.monotonic() - started:.2f} с.")
+
+def compress_chunk(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=READER_ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, READER_ZLIB_LEVEL)
+
+def decompress_chunk(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Книга сжата zstd, но пакет zstandard не установлен")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def store_book_content(cursor, content, page_offsets):
+    """
+    Сохраняет текст книги сжатыми блоками по READER_CHUNK_PAGES страниц, если такого
+    текста ещё нет. Блок - это срез текста от начала первой до конца последней его страницы.
+    Вызывается внутри транзакции записи (BEGIN IMMEDIATE). Возвращает content_hash.
+    """
+    content_hash = book_content_hash(content)
+    cursor.execute('SELECT 1 FROM book_contents WHERE content_hash = ?', (content_hash,))
+    if cursor.fetchone() is not None:
+        return content_hash
+    total_pages = len(page_offsets) // 2
+    stored_size = 0
+    for chunk, first_page in enumerate(range(0, total_pages, READER_CHUNK_PAGES)):
+        last_page = min(first_page + READER_CHUNK_PAGES, total_pages) - 1
+        data = compress_chunk(content[page_offsets[2 * first_page]:page_offsets[2 * last_page + 1]].encode('utf-8'), READER_CODEC)
+        stored_size += len(data)
+        cursor.execute('INSERT INTO book_chunks (content_hash, chunk, data) VALUES (?, ?, ?)', (content_hash, chunk, data))
+    cursor.execute('''
+        INSERT INTO book_contents (content_hash, page_offsets, total_pages, codec, content_size, stored_size)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (content_hash, page_offsets.tobytes(), total_pages, READER_CODEC, len(content.encode('utf-8')), stored_size))
+    return content_hash
 
 
 # =================================================================
@@ -134,60 +2317,187 @@ def is_user_admin(user_id):
     return user_id in ADMIN_IDS
 
 
-def save_user_state(user_id, title, author, series, series_number, content, page, total_pages):
-    """Сохраняет или обновляет текущее состояние чтения пользователя."""
+def book_content_hash(content):
+    """Ключ текста книги в book_contents: SHA-256 нормализованного текста."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def delete_unused_content(cursor, content_hash):
+    """
+    Удаляет текст книги, если его больше не читает ни один пользователь.
+    Вызывается внутри транзакции записи (BEGIN IMMEDIATE), начатой до проверки ссылок.
+    """
+    cursor.execute('SELECT 1 FROM reading_sessions WHERE content_hash = ?', (content_hash,))
+    if cursor.fetchone() is None:
+        cursor.execute('DELETE FROM book_chunks WHERE content_hash = ?', (content_hash,))
+        cursor.execute('DELETE FROM book_contents WHERE content_hash = ?', (content_hash,))
+
+def save_user_book(user_id, title, author, series, series_number, content, page_offsets):
+    """Добавляет книгу пользователю (или открывает заново) и начинает чтение с первой страницы."""
     book_id = hashlib.sha256(f"{user_id}{title}{author}{series}{series_number}".encode('utf-8')).hexdigest()
     conn = db_connect()
     cursor = conn.cursor()
-    
+    # Транзакция записи начинается до проверки наличия текста: иначе другой поток может
+    # удалить этот текст (delete_unused_content) между проверкой и ссылкой на него
+    cursor.execute('BEGIN IMMEDIATE')
     cursor.execute('SELECT COUNT(*) FROM reading_sessions WHERE user_id = ?', (user_id,))
     book_count = cursor.fetchone()[0]
 
     if book_count >= MAX_BOOKS:
         cursor.execute('SELECT 1 FROM reading_sessions WHERE user_id = ? AND book_id = ?', (user_id, book_id))
         if cursor.fetchone() is None:
-            conn.close()
+            conn.rollback()
             return 'limit_reached'
 
+    progress_buffer.discard(user_id, book_id)
+    content_hash = store_book_content(cursor, content, page_offsets)
+    cursor.execute('SELECT content_hash FROM reading_sessions WHERE user_id = ? AND book_id = ?', (user_id, book_id))
+    previous = cursor.fetchone()
     cursor.execute('''
         INSERT OR REPLACE INTO reading_sessions 
-        (user_id, book_id, book_title, book_author, book_series, series_number, book_content, current_page, total_pages)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, book_id, title, author, series, series_number, content, page, total_pages))
+        (user_id, book_id, short_id, book_title, book_author, book_series, series_number, content_hash, current_page)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+    ''', (user_id, book_id, book_id[:SHORT_BOOK_ID_LENGTH], title, author, series, series_number, content_hash))
+    if previous and previous[0] != content_hash:
+        delete_unused_content(cursor, previous[0])
     conn.commit()
-    conn.close()
-    logger.info(f"Состояние чтения для пользователя {user_id} сохранено. Страница: {page}.")
+    logger.info(f"Книга '{title}' добавлена пользователю {user_id}.")
     return 'success'
 
+def save_reading_progress(user_id, book_id, page):
+    """Запоминает текущую страницу, на которой пользователь читает книгу (запись в базу - через progress_buffer)."""
+    progress_buffer.put(user_id, book_id, page)
+    logger.info(f"Состояние чтения для пользователя {user_id} сохранено. Страница: {page}.")
+
+def write_reading_progress(rows):
+    """Записывает в базу пачку (страница, user_id, book_id) одной транзакцией."""
+    conn = db_connect()
+    conn.executemany('UPDATE reading_sessions SET current_page = ?, timestamp = CURRENT_TIMESTAMP WHERE user_id = ? AND book_id = ?',
+                     rows)
+    conn.commit()
+
 def load_user_state(user_id, book_id):
     """Загружает текущее состояние чтения пользователя для конкретной книги."""
     conn = db_connect()
     cursor = conn.cursor()
-    cursor.execute('SELECT book_title, book_author, book_series, series_number, book_content, current_page, total_pages FROM reading_sessions WHERE user_id = ? AND book_id = ?', (user_id, book_id))
+    cursor.execute('''
+        SELECT s.book_title, s.book_author, s.book_series, s.series_number, s.content_hash, s.current_page, c.total_pages, c.page_offsets, c.codec
+        FROM reading_sessions s JOIN book_contents c ON c.content_hash = s.content_hash
+        WHERE s.user_id = ? AND s.book_id = ?
+    ''', (user_id, book_id))
     result = cursor.fetchone()
-    conn.close()
     if result:
-        return {'title': result[0], 'author': result[1], 'series': result[2], 'series_number': result[3], 'content': result[4], 'current_page': result[5], 'total_pages': result[6]}
+        current_page = progress_buffer.get(user_id, book_id)
+        return {'title': result[0], 'author': result[1], 'series': result[2], 'series_number': result[3], 'content_hash': result[4],
+                'current_page': result[5] if current_page is None else current_page, 'total_pages': result[6],
+                'page_offsets': array('I', result[7]), 'codec': result[8]}
     return None
 
+def load_book_page(reading_state, page_number):
+    """Возвращает текст страницы книги, распаковывая только блок, в котором она лежит."""
+    page_offsets = reading_state['page_offsets']
+    if not 0 <= page_number < len(page_offsets) // 2:
+        return ""
+    chunk = page_number // READER_CHUNK_PAGES
+    conn = db_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT data FROM book_chunks WHERE content_hash = ? AND chunk = ?', (reading_state['content_hash'], chunk))
+    result = cursor.fetchone()
+    if not result:
+        return ""
+    started = time.perf_counter()
+    text = decompress_chunk(result[0], reading_state['codec']).decode('utf-8')
+    reader_stats.record(len(result[0]), time.perf_counter() - started)
+    base = page_offsets[2 * chunk * READER_CHUNK_PAGES]
+    return text[page_offsets[2 * page_number] - base:page_offsets[2 * page_number + 1] - base]
+
+def reader_storage_report():
+    """Сводка по хранилищу книг читалки для статистики администратора."""
+    conn = db_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*), COALESCE(SUM(content_size), 0), COALESCE(SUM(stored_size), 0) FROM book_contents')
+    books, content_size, stored_size = cursor.fetchone()
+    # В режиме WAL часть данных до контрольной точки лежит в файле журнала
+    db_size = sum(os.path.getsize(path) for path in (DB_FILE, f"{DB_FILE}-wal") if os.path.exists(path))
+    ratio = content_size / stored_size if stored_size else 0
+    return (f"База читалки: {db_size / 1024 / 1024:.1f} МБ, текстов книг {books}: "
+            f"{content_size / 1024 / 1024:.1f} МБ, сжато {READER_CODEC} до {stored_size / 1024 / 1024:.1f} МБ (в {ratio:.1f} раза)")
+
 def get_user_books(user_id):
     """Возвращает список всех книг, которые читает пользователь."""
     conn = db_connect()
     cursor = conn.cursor()
-    cursor.execute('SELECT book_id, book_title, book_author, book_series, series_number, current_page, total_pages FROM reading_sessions WHERE user_id = ? ORDER BY timestamp DESC', (user_id,))
-    books = cursor.fetchall()
-    conn.close()
+    cursor.execute('''
+        SELECT s.book_id, s.book_title, s.book_author, s.book_series, s.series_number, s.current_page, c.total_pages
+        FROM reading_sessions s JOIN book_contents c ON c.content_hash = s.content_hash
+        WHERE s.user_id = ? ORDER BY s.timestamp DESC
+    ''', (user_id,))
+    books = []
+    for book_id, title, author, series, series_number, page, total_pages in cursor.fetchall():
+        pending_page = progress_buffer.get(user_id, book_id)
+        books.append((book_id, title, author, series, series_number, page if pending_page is None else pending_page, total_pages))
     return books
 
 def delete_user_book(user_id, book_id):
     """Удаляет книгу из базы данных для пользователя."""
     conn = db_connect()
     cursor = conn.cursor()
+    progress_buffer.discard(user_id, book_id)
+    # Проверка ссылок на текст и его удаление - в одной транзакции записи, как в save_user_book
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('SELECT content_hash FROM reading_sessions WHERE user_id = ? AND book_id = ?', (user_id, book_id))
+    result = cursor.fetchone()
     cursor.execute('DELETE FROM reading_sessions WHERE user_id = ? AND book_id = ?', (user_id, book_id))
+    if result:
+        delete_unused_content(cursor, result[0])
     conn.commit()
-    conn.close()
     logger.info(f"Книга с id '{book_id}' удалена для пользователя {user_id}.")
 
+def load_user_filters(user_id):
+    """Возвращает фильтры поиска пользователя: (скрывать удалённые, языки, форматы)."""
+    conn = db_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT hide_deleted, languages, formats FROM user_preferences WHERE user_id = ?', (user_id,))
+    result = cursor.fetchone()
+    if result:
+        return (bool(result[0]), tuple(filter(None, result[1].split(','))), tuple(filter(None, result[2].split(','))))
+    return DEFAULT_SEARCH_FILTERS
+
+def save_user_filters(user_id, filters):
+    """Сохраняет фильтры поиска пользователя."""
+    hide_deleted, languages, formats = filters
+    conn = db_connect()
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR REPLACE INTO user_preferences (user_id, hide_deleted, languages, formats) VALUES (?, ?, ?, ?)',
+                   (user_id, int(hide_deleted), ','.join(languages), ','.join(formats)))
+    conn.commit()
+    logger.info(f"Фильтры поиска пользователя {user_id} сохранены: {filters}.")
+
+# Фрагменты описаний ошибок Telegram, означающих, что сохранённый file_id больше не действителен
+INVALID_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'wrong file_id',
+                          'file_reference', 'file reference')
+
+def load_telegram_file_id(libid):
+    """Возвращает file_id уже загруженного в Telegram файла книги или None."""
+    conn = db_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT file_id FROM telegram_files WHERE libid = ?', (libid,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+def save_telegram_file_id(libid, file_id):
+    """Запоминает file_id, который Telegram вернул после загрузки файла книги."""
+    conn = db_connect()
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR REPLACE INTO telegram_files (libid, file_id) VALUES (?, ?)', (libid, file_id))
+    conn.commit()
+
+def delete_telegram_file_id(libid):
+    """Удаляет file_id, который Telegram больше не принимает."""
+    conn = db_connect()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM telegram_files WHERE libid = ?', (libid,))
+    conn.commit()
+
 # =================================================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # =================================================================
@@ -275,51 +2585,57 @@ def parse_fb2(file_content):
         logger.error(f"Ошибка при парсинге FB2: {e}")
         return None, None, None, -1, None
 
-def get_page_text(book_content, page_number):
-    """Возвращает текст для заданной страницы, избегая разрывов внутри абзацев."""
-    paragraphs = book_content.split("\n\n")
-    
-    pages = []
-    current_page = []
+def paginate_book(book_text):
+    """
+    Разбивает текст книги на страницы до PAGE_SIZE символов, избегая разрывов внутри
+    абзацев (абзацы длиннее страницы режутся по кускам). Возвращает нормализованный
+    текст (непустые абзацы через "\n\n") и таблицу страниц: начало и конец среза
+    каждой страницы в этом тексте, подряд в одном массиве.
+    """
+    paragraphs = [para for para in (para.strip() for para in book_text.split("\n\n")) if para]
+    page_offsets = array('I')
+    page_start = None
+    page_end = 0
     current_len = 0
-
+    position = 0
     for para in paragraphs:
-        para = para.strip()
-        if not para:
-            continue
+        para_start = position
+        para_end = position + len(para)
+        position = para_end + 2
         # Если абзац полностью влезает в текущую страницу
         if current_len + len(para) + 2 <= PAGE_SIZE:
-            current_page.append(para)
+            if page_start is None:
+                page_start = para_start
+            page_end = para_end
             current_len += len(para) + 2
+        # Если абзац длинный — режем его по кускам, первый кусок дописываем к текущей странице
+        elif len(para) > PAGE_SIZE:
+            for chunk_start in range(para_start, para_end, PAGE_SIZE):
+                page_offsets.extend((chunk_start if page_start is None else page_start,
+                                     min(chunk_start + PAGE_SIZE, para_end)))
+                page_start = None
+            current_len = 0
         else:
-            # Если абзац длинный — режем его по кускам
-            if len(para) > PAGE_SIZE:
-                start = 0
-                while start < len(para):
-                    chunk = para[start:start+PAGE_SIZE]
-                    current_page.append(chunk)
-                    pages.append("\n\n".join(current_page))
-                    current_page = []
-                    current_len = 0
-                    start += PAGE_SIZE
-            else:
-                # Закрываем текущую страницу
-                pages.append("\n\n".join(current_page))
-                current_page = [para]
-                current_len = len(para) + 2
-    
-    if current_page:
-        pages.append("\n\n".join(current_page))
-    
-    # Возврат нужной страницы
-    if page_number < len(pages):
-        return pages[page_number]
+            # Закрываем текущую страницу
+            if page_start is not None:
+                page_offsets.extend((page_start, page_end))
+            page_start = para_start
+            page_end = para_end
+            current_len = len(para) + 2
+    if page_start is not None:
+        page_offsets.extend((page_start, page_end))
+    return "\n\n".join(paragraphs), page_offsets
+
+def get_page_text(book_content, page_offsets, page_number):
+    """Возвращает текст заданной страницы по таблице страниц из paginate_book."""
+    if 0 <= page_number < len(page_offsets) // 2:
+        return book_content[page_offsets[2 * page_number]:page_offsets[2 * page_number + 1]]
     return ""
 
 def get_reading_keyboard(book_id, total_pages, current_page):
     """Создает клавиатуру с кнопками 'Назад', 'Мои книги' и 'Далее'."""
     markup = InlineKeyboardMarkup()
-    short_book_id = book_id[:16]
+    short_book_id = book_id[:SHORT_BOOK_ID_LENGTH]
     
     buttons = []
     if current_page > 0:
@@ -336,7 +2652,7 @@ def get_reading_keyboard(book_id, total_pages, current_page):
 def get_book_actions_keyboard(book_id):
     """Создает клавиатуру для действий с книгой (Читать, удалить)."""
     markup = InlineKeyboardMarkup()
-    short_book_id = book_id[:16]
+    short_book_id = book_id[:SHORT_BOOK_ID_LENGTH]
     markup.row(
         InlineKeyboardButton("📕 Читать", callback_data=f"read_book:{short_book_id}"),
         InlineKeyboardButton("➡️ Страница", callback_data=f"goto_page:{short_book_id}"),
@@ -350,17 +2666,12 @@ def handle_goto_page(call):
     short_book_id = call.data.split(':')[1]
 
     # Ищем полный book_id
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT book_id FROM reading_sessions WHERE user_id = ? AND book_id LIKE ?', (chat_id, f"{short_book_id}%"))
-    result = cursor.fetchone()
-    conn.close()
+    book_id = find_user_book_id(chat_id, short_book_id)
 
-    if not result:
+    if not book_id:
         bot.answer_callback_query(call.id, "Книга не найдена.")
         return
 
-    book_id = result[0]
     # Запоминаем состояние — ждём ввода номера страницы
     user_state[chat_id] = {"action": "goto_page", "book_id": book_id}
     bot.send_message(chat_id, "Введите номер страницы, на которую хотите перейти:")
@@ -391,7 +2702,7 @@ def handle_page_input(message):
         bot.send_message(chat_id, f"Укажите число от 1 до {total_pages}.")
         return
 
-    page_text = get_page_text(reading_state['content'], page_number)
+    page_text = load_book_page(reading_state, page_number)
     response_text = f"**{escape_markdown(reading_state['title'])}**\n"
     if reading_state['series'] and reading_state['series'] != "Нет серии":
         series_info = f"_{escape_markdown(reading_state['series'])}"
@@ -406,8 +2717,7 @@ def handle_page_input(message):
     bot.send_message(chat_id, response_text, reply_markup=get_reading_keyboard(book_id, total_pages, page_number), parse_mode="MarkdownV2")
 
     # Сохраняем прогресс
-    save_user_state(chat_id, reading_state['title'], reading_state['author'], reading_state['series'],
-                    reading_state['series_number'], reading_state['content'], page_number, total_pages)
+    save_reading_progress(chat_id, book_id, page_number)
 
     # Чистим состояние
     del user_state[chat_id] 
@@ -466,16 +2776,17 @@ def handle_document(message):
         bot.send_message(chat_id, "Не удалось прочитать книгу\\. Возможно, файл поврежден\\.", parse_mode="MarkdownV2")
         return
 
-    total_pages = (len(book_text) + PAGE_SIZE - 1) // PAGE_SIZE
+    book_text, page_offsets = paginate_book(book_text)
+    total_pages = len(page_offsets) // 2
     
-    save_result = save_user_state(chat_id, title, author, series, series_number, book_text, 0, total_pages)
+    save_result = save_user_book(chat_id, title, author, series, series_number, book_text, page_offsets)
     if save_result == 'limit_reached':
         bot.send_message(chat_id, f"Вы достигли лимита в {MAX_BOOKS} книг\\. Пожалуйста, удалите одну из старых книг с помощью команды /mybooks, чтобы добавить новую\\.", parse_mode="MarkdownV2")
         return
         
     book_id = hashlib.sha256(f"{chat_id}{title}{author}{series}{series_number}".encode('utf-8')).hexdigest()
     
-    first_page_text = get_page_text(book_text, 0)
+    first_page_text = get_page_text(book_text, page_offsets, 0)
     
     response_text = f"**Начинаем читать:** {escape_markdown(title)}\n"
     if series and series != "Нет серии":
@@ -500,17 +2811,12 @@ def handle_next_page(call):
     chat_id = call.message.chat.id
     short_book_id = call.data.split(':')[1]
     
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT book_id FROM reading_sessions WHERE user_id = ? AND book_id LIKE ?', (chat_id, f"{short_book_id}%"))
-    result = cursor.fetchone()
-    conn.close()
+    book_id = find_user_book_id(chat_id, short_book_id)
     
-    if not result:
+    if not book_id:
         bot.send_message(chat_id, "Сессия чтения завершена\\. Пожалуйста, выберите книгу из списка или отправьте новую\\.", parse_mode="MarkdownV2")
         return
         
-    book_id = result[0]
     
     reading_state = load_user_state(chat_id, book_id)
     if not reading_state:
@@ -525,7 +2831,7 @@ def handle_next_page(call):
         return
 
     next_page_number = current_page + 1
-    page_text = get_page_text(reading_state['content'], next_page_number)
+    page_text = load_book_page(reading_state, next_page_number)
     
     response_text = f"**{escape_markdown(reading_state['title'])}**\n"
     if reading_state['series'] and reading_state['series'] != "Нет серии":
@@ -540,24 +2846,19 @@ def handle_next_page(call):
     
     bot.edit_message_text(response_text, chat_id, call.message.message_id, reply_markup=get_reading_keyboard(book_id, total_pages, next_page_number), parse_mode="MarkdownV2")
     bot.answer_callback_query(call.id)
-    save_user_state(chat_id, reading_state['title'], reading_state['author'], reading_state['series'], reading_state['series_number'], reading_state['content'], next_page_number, total_pages)
+    save_reading_progress(chat_id, book_id, next_page_number)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('prev_page:'))
 def handle_prev_page(call):
     chat_id = call.message.chat.id
     short_book_id = call.data.split(':')[1]
     
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT book_id FROM reading_sessions WHERE user_id = ? AND book_id LIKE ?', (chat_id, f"{short_book_id}%"))
-    result = cursor.fetchone()
-    conn.close()
+    book_id = find_user_book_id(chat_id, short_book_id)
     
-    if not result:
+    if not book_id:
         bot.send_message(chat_id, "Сессия чтения завершена\\. Пожалуйста, выберите книгу из списка или отправьте новую\\.", parse_mode="MarkdownV2")
         return
         
-    book_id = result[0]
     
     reading_state = load_user_state(chat_id, book_id)
     if not reading_state:
@@ -572,7 +2873,7 @@ def handle_prev_page(call):
         return
 
     prev_page_number = current_page - 1
-    page_text = get_page_text(reading_state['content'], prev_page_number)
+    page_text = load_book_page(reading_state, prev_page_number)
     
     response_text = f"**{escape_markdown(reading_state['title'])}**\n"
     if reading_state['series'] and reading_state['series'] != "Нет серии":
@@ -587,7 +2888,7 @@ def handle_prev_page(call):
     
     bot.edit_message_text(response_text, chat_id, call.message.message_id, reply_markup=get_reading_keyboard(book_id, total_pages, prev_page_number), parse_mode="MarkdownV2")
     bot.answer_callback_query(call.id)
-    save_user_state(chat_id, reading_state['title'], reading_state['author'], reading_state['series'], reading_state['series_number'], reading_state['content'], prev_page_number, total_pages)
+    save_reading_progress(chat_id, book_id, prev_page_number)
     
 
 
@@ -641,17 +2942,12 @@ def handle_read_book_callback(call):
     chat_id = call.message.chat.id
     short_book_id = call.data.split(':')[1]
     
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT book_id FROM reading_sessions WHERE user_id = ? AND book_id LIKE ?', (chat_id, f"{short_book_id}%"))
-    result = cursor.fetchone()
-    conn.close()
+    book_id = find_user_book_id(chat_id, short_book_id)
     
-    if not result:
+    if not book_id:
         bot.answer_callback_query(call.id, "Книга не найдена\\.")
         return
         
-    book_id = result[0]
 
     reading_state = load_user_state(chat_id, book_id)
     if not reading_state:
@@ -661,7 +2957,7 @@ def handle_read_book_callback(call):
     current_page = reading_state['current_page']
     total_pages = reading_state['total_pages']
 
-    page_text = get_page_text(reading_state['content'], current_page)
+    page_text = load_book_page(reading_state, current_page)
     
     response_text = f"**Продолжаем читать:** {escape_markdown(reading_state['title'])}\n"
     if reading_state['series'] and reading_state['series'] != "Нет серии":
@@ -682,17 +2978,12 @@ def handle_delete_book_callback(call):
     chat_id = call.message.chat.id
     short_book_id = call.data.split(':')[1]
     
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT book_id FROM reading_sessions WHERE user_id = ? AND book_id LIKE ?', (chat_id, f"{short_book_id}%"))
-    result = cursor.fetchone()
-    conn.close()
+    book_id = find_user_book_id(chat_id, short_book_id)
     
-    if not result:
+    if not book_id:
         bot.answer_callback_query(call.id, "Книга не найдена\\.")
         return
         
-    book_id = result[0]
     
     delete_user_book(chat_id, book_id)
     bot.send_message(chat_id, "Книга успешно удалена\\.", parse_mode="MarkdownV2")
@@ -702,112 +2993,389 @@ def handle_delete_book_callback(call):
 # =================================================================
 # ФУНКЦИИ ИЗ НАШЕЙ ПРОГРАММЫ
 # =================================================================
+def fold_text(text):
+    """
+    Приводит строку к единой форме для сравнения: Unicode NFKC,
+    casefold и замена 'ё' на 'е'.
+    """
+    return unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+
 def normalize_query(text):
     """
     Normalizes a string by replacing double letters with single ones.
     Example: 'ss' -> 's', 'pp' -> 'p'.
+    The text is folded first (NFKC, casefold, 'ё' -> 'е').
+    """
+    # This regex matches any letter followed by the same letter.
+    # It replaces the pair with a single instance of the letter (digits are kept as is).
+    return re.sub(r'([^\W\d_])\1+', r'\1', fold_text(text))
+
+def pattern_masks(word):
+    """Битовые маски позиций каждого символа слова (для levenshtein)."""
+    masks = {}
+    for position, char in enumerate(word):
+        masks[char] = masks.get(char, 0) | (1 << position)
+    return masks
+
+def levenshtein(word, masks, other):
+    """
+    Расстояние Левенштейна между word и other битово-параллельным алгоритмом
+    Майерса-Хиррё; masks - pattern_masks(word), считается один раз на слово.
+    """
+    length = len(word)
+    if not length:
+        return len(other)
+    full = (1 << length) - 1
+    high = 1 << (length - 1)
+    positive, negative, distance = full, 0, length
+    for char in other:
+        eq = masks.get(char, 0)
+        xv = eq | negative
+        xh = (((eq & positive) + positive) ^ positive) | eq
+        ph = negative | (~(xh | positive) & full)
+        mh = positive & xh
+        if ph & high:
+            distance += 1
+        elif mh & high:
+            distance -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        positive = mh | (~(xv | ph) & full)
+        negative = ph & xv
+    return distance
+
+def correct_words(text, trees, exists, deadline):
+    """
+    Исправляет опечатки в нормализованном тексте запроса: слово, которого нет в каталоге
+    (exists(word) ложно), заменяется ближайшим словом из BK-деревьев trees - на расстоянии 1,
+    а для слов от 8 букв - до 2. Возвращает исправленный текст или None, если исправлять
+    нечего, не удалось найти замену или истёк лимит времени (deadline).
+    """
+    words = text.split()
+    changed = False
+    for position, word in enumerate(words):
+        if len(word) < FUZZY_MIN_LENGTH or not word.isalpha() or exists(word):
+            continue
+        if time.monotonic() > deadline:
+            return None
+        max_distance = 1 if len(word) < 8 else 2
+        matches = [match for match in (tree.closest(word, max_distance, deadline) for tree in trees) if match]
+        if not matches:
+            return None
+        words[position] = min(matches)[1]
+        changed = True
+    return ' '.join(words) if changed else None
+
+def translit_text(text):
+    """
+    Приводит нормализованный текст (normalize_query) к латинскому скелету транслитерации:
+    'Глуховский', 'Glukhovskiy', 'gluhovsky' и 'Gluhovskij' дают одно и то же 'gluhovski'.
+    Цифры и разделители сохраняются, удвоенные буквы схлопываются, как в normalize_query.
     """
-    # This regex matches any letter (a-z) followed by the same letter.
-    # It replaces the pair with a single instance of the letter.
-    return re.sub(r'(.)\1+', r'\1', text.lower())
+    text = text.translate(TRANSLIT_TABLE)
+    for source, target in TRANSLIT_DIGRAPHS:
+        text = text.replace(source, target)
+    return re.sub(r'([^\W\d_])\1+', r'\1', text.translate(TRANSLIT_LETTERS))
 
-def load_inpx_data(inpx_path):
-    """Загружает и парсит данные из всех INP-файлов."""
-    global books_data
-    books_data = []
+def smart_search_key(book):
+    """
+    Нормализованный ключ книги для поиска: автор, название, серия и номер,
+    каждое поле нормализовано отдельно, поля разделены переводом строки.
+    """
+    return '\n'.join(normalize_query(book[field]) for field in SEARCH_KEY_FIELDS)
+
+def inp_member_signature(info):
+    """Подпись INP-файла внутри INPX: меняется при любом изменении его содержимого."""
+    return (info.CRC, info.file_size)
+
+def parse_inp_member(inpx_path, inp_file_name):
+    """
+    Парсит один INP-файл из архива INPX в отдельный частичный каталог.
+    Выполняется в процессе-воркере, возвращает (каталог, время разбора в секундах).
+    """
+    started = time.monotonic()
+    catalog = BookCatalog()
+    archive_name = inp_file_name.replace('.inp', '.zip')
+    with zipfile.ZipFile(inpx_path, 'r') as archive:
+        signature = inp_member_signature(archive.getinfo(inp_file_name))
+        with archive.open(inp_file_name) as inp_file:
+            for line in inp_file:
+                try:
+                    decoded_line = line.decode('utf-8', errors='ignore').strip()
+                    parts = decoded_line.split('\x04')
+                    if len(parts) >= len(FIELDS):
+                        book_info = dict(zip(FIELDS, parts))
+                        if CATALOG_DROP_DELETED and book_info['DEL'].strip() == '1':
+                            continue
+
+                        if ':' in book_info['AUTHOR']:
+                            book_info['AUTHOR'] = book_info['AUTHOR'].replace(':', '')
+                        # Коды жанров оставляем разделёнными ':' - по ним строится фасет жанров
+                        book_info['GENRE'] = book_info['GENRE'].strip(':')
+
+                        book_info['INP_ARCHIVE_NAME'] = archive_name
+                        catalog.append(book_info)
+                except (UnicodeDecodeError, IndexError, ValueError):
+                    continue
+    catalog.members[inp_file_name] = (0, catalog.count, signature)
+    return catalog.freeze(), time.monotonic() - started
+
+def parse_inp_members(inpx_path, inp_files):
+    """
+    Парсит список INP-файлов, при возможности - параллельно в INPX_WORKERS процессах.
+    Результаты возвращаются в порядке inp_files, независимо от порядка завершения.
+    """
+    workers = max(1, min(INPX_WORKERS, len(inp_files)))
+    if workers > 1:
+        # Бот к этому моменту уже многопоточный, а fork копирует чужие захваченные блокировки,
+        # поэтому процессы запускаются через forkserver (на Windows - spawn)
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) as executor:
+                return list(executor.map(parse_inp_member, repeat(inpx_path), inp_files))
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning(f"Параллельная загрузка недоступна ({e}), загружаем INP-файлы последовательно.")
+    return [parse_inp_member(inpx_path, inp_file_name) for inp_file_name in inp_files]
+
+def parse_inpx_catalog(inpx_path):
+    """Парсит все INP-файлы архива INPX и возвращает каталог (или None при ошибке)."""
     try:
         with zipfile.ZipFile(inpx_path, 'r') as archive:
             inp_files = [f for f in archive.namelist() if f.lower().endswith('.inp')]
-            if not inp_files:
-                logger.error("Ошибка: В INPX-архиве не найдено ни одного .inp файла.")
-                return False
-
-            logger.info(f"Найдено {len(inp_files)} INP-файлов. Загрузка...")
-            for inp_file_name in inp_files:
-                with archive.open(inp_file_name) as inp_file:
-                    for line in inp_file:
-                        try:
-                            decoded_line = line.decode('utf-8', errors='ignore').strip()
-                            parts = decoded_line.split('')
-                            if len(parts) >= len(FIELDS):
-                                book_info = dict(zip(FIELDS, parts))
-                                
-                                if ':' in book_info['AUTHOR']:
-                                    book_info['AUTHOR'] = book_info['AUTHOR'].replace(':', '')
-                                if ':' in book_info['GENRE']:
-                                    book_info['GENRE'] = book_info['GENRE'].replace(':', '')
-
-                                book_info['INP_ARCHIVE_NAME'] = inp_file_name.replace('.inp', '.zip')
-                                books_data.append(book_info)
-                        except (UnicodeDecodeError, IndexError, ValueError):
-                            continue
+        if not inp_files:
+            logger.error("Ошибка: В INPX-архиве не найдено ни одного .inp файла.")
+            return None
+
+        logger.info(f"Найдено {len(inp_files)} INP-файлов. Загрузка в {min(INPX_WORKERS, len(inp_files))} процессах...")
+        catalog = BookCatalog()
+        for inp_file_name, (part, elapsed) in zip(inp_files, parse_inp_members(inpx_path, inp_files)):
+            logger.info(f"INP-файл '{inp_file_name}': {len(part)} книг за {elapsed:.2f} с.")
+            catalog.extend(part)
     except (FileNotFoundError, zipfile.BadZipFile) as e:
+        logger.error(f"Ошибка при загрузке каталога: {e}")
+        return None
+    return catalog.freeze().build_indexes()
+
+def inpx_signature(inpx_path):
+    """
+    Возвращает размер, время изменения и хеш INPX-файла - ключ снимка каталога.
+    В ключ входит и CATALOG_DROP_DELETED: снимок без удалённых книг не подходит для полного каталога.
+    """
+    stat = os.stat(inpx_path)
+    digest = hashlib.sha1()
+    with open(inpx_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': digest.hexdigest(),
+            'drop_deleted': CATALOG_DROP_DELETED}
+
+def save_catalog_snapshot(catalog, signature):
+    """Сохраняет готовый каталог в бинарный снимок рядом с базой данных."""
+    temp_path = f"{CATALOG_SNAPSHOT_FILE}.tmp"
+    try:
+        os.makedirs(os.path.dirname(CATALOG_SNAPSHOT_FILE), exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            pickle.dump({'version': CATALOG_SNAPSHOT_VERSION, 'signature': signature, 'catalog': catalog},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, CATALOG_SNAPSHOT_FILE)
+        logger.info(f"Снимок каталога сохранен: {CATALOG_SNAPSHOT_FILE}.")
+    except Exception as e:
+        logger.error(f"Не удалось сохранить снимок каталога: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def load_catalog_snapshot(signature):
+    """Загружает каталог из снимка, если он соответствует текущему INPX-файлу."""
+    if not os.path.exists(CATALOG_SNAPSHOT_FILE):
+        return None
+    try:
+        with open(CATALOG_SNAPSHOT_FILE, 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        logger.warning(f"Снимок каталога поврежден и будет пересоздан: {e}")
+        return None
+    if snapshot.get('version') != CATALOG_SNAPSHOT_VERSION or snapshot.get('signature') != signature:
+        logger.info("Снимок каталога устарел, каталог будет загружен из INPX.")
+        return None
+    return snapshot['catalog']
+
+def set_catalog(catalog):
+    """Делает каталог текущим: присваивает ему новую версию и сбрасывает кэш поиска."""
+    global books_data
+    catalog.version = next(catalog_versions)
+    books_data = catalog
+    query_cache.clear()
+
+def load_inpx_data(inpx_path):
+    """Загружает каталог из снимка или, если снимок устарел, парсит все INP-файлы."""
+    global loaded_inpx_stat
+    started = time.monotonic()
+    try:
+        signature = inpx_signature(inpx_path)
+    except FileNotFoundError as e:
         logger.error(f"Ошибка при загрузке каталога: {e}")
         return False
+    loaded_inpx_stat = (signature['size'], signature['mtime'])
+
+    if CATALOG_BACKEND == 'sqlite':
+        catalog = open_sqlite_catalog(inpx_path, signature)
+        if catalog is None:
+            return False
+        logger.info(f"Каталог SQLite открыт за {time.monotonic() - started:.2f} с.")
+        set_catalog(catalog)
+        logger.info(books_data.memory_report())
+        return True
+
+    catalog = load_catalog_snapshot(signature)
+    if catalog is not None:
+        logger.info(f"Каталог загружен из снимка за {time.monotonic() - started:.2f} с.")
+    else:
+        catalog = parse_inpx_catalog(inpx_path)
+        if catalog is None:
+            return False
+        logger.info(f"Каталог загружен из INPX за {time.monotonic() - started:.2f} с.")
+        save_catalog_snapshot(catalog, signature)
+
+    set_catalog(catalog)
+    logger.info(books_data.memory_report())
     return True
 
-def search_book(books_data, author, title, series, series_number, date):
+def reload_catalog(inpx_path):
     """
-    Ищет книгу в списке данных по заданным критериям.
-    Возвращает список найденных книг.
+    Инкрементально обновляет каталог: парсит только новые или изменённые INP-файлы,
+    записи остальных берёт из текущего каталога и атомарно подменяет books_data.
+    Каталог SQLite при любом изменении INPX пересобирается целиком.
+    Пока идёт обновление, поиск и скачивание работают со старым каталогом.
+    Возвращает (число перечитанных файлов, число удалённых файлов) или None при ошибке.
     """
-    results = []
-    author = author.lower()
-    title = title.lower()
-    series = series.lower()
-    series_number = series_number.lower()
-    date = date.lower()
+    with catalog_reload_lock:
+        started = time.monotonic()
+        current = books_data
+        try:
+            signature = inpx_signature(inpx_path)
+            with zipfile.ZipFile(inpx_path, 'r') as archive:
+                inp_infos = [info for info in archive.infolist() if info.filename.lower().endswith('.inp')]
+        except (FileNotFoundError, zipfile.BadZipFile) as e:
+            logger.error(f"Ошибка при обновлении каталога: {e}")
+            return None
+
+        changed = [info.filename for info in inp_infos
+                   if current.members.get(info.filename, (0, 0, None))[2] != inp_member_signature(info)]
+        removed = set(current.members) - {info.filename for info in inp_infos}
+        if not changed and not removed:
+            logger.info("Обновление каталога: изменений в INPX нет.")
+            return 0, 0
+
+        logger.info(f"Обновление каталога: перечитываем {len(changed)} INP-файлов, удалено {len(removed)}.")
+        if CATALOG_BACKEND == 'sqlite':
+            # База SQLite пересобирается во временный файл; старый каталог работает до подмены
+            if not build_sqlite_catalog(inpx_path, CATALOG_DB_FILE, signature):
+                return None
+            set_catalog(SqliteCatalog(CATALOG_DB_FILE))
+            logger.info(f"Каталог обновлен за {time.monotonic() - started:.2f} с. {books_data.memory_report()}")
+            threading.Thread(target=refresh_member_index, daemon=True).start()
+            return len(changed), len(removed)
+
+        parsed = {}
+        for inp_file_name, (part, elapsed) in zip(changed, parse_inp_members(inpx_path, changed)):
+            logger.info(f"INP-файл '{inp_file_name}': {len(part)} книг за {elapsed:.2f} с.")
+            parsed[inp_file_name] = part
+
+        catalog = BookCatalog()
+        for info in inp_infos:
+            if info.filename in parsed:
+                catalog.extend(parsed[info.filename])
+            else:
+                catalog.extend(current.member_slice(info.filename))
+        catalog.freeze().build_indexes()
 
-    for book in books_data:
-        match = True
-        
-        if author and author not in book['AUTHOR'].lower():
-            match = False
-        
-        if title and title not in book['TITLE'].lower():
-            match = False
-        
-        if series and series not in book['SERIES'].lower():
-            match = False
-            
-        if series_number and series_number not in book['SERNO'].lower():
-            match = False
-            
-        if date and date not in book['DATE'].lower():
-            match = False
-            
-        if match:
-            results.append(book)
-            
-    # Сортировка результатов по номеру серии
-    results.sort(key=lambda x: int(x.get('SERNO', '0')) if x.get('SERNO', '0').isdigit() else float('inf'))
-            
-    return results
+        set_catalog(catalog)
+        logger.info(f"Каталог обновлен за {time.monotonic() - started:.2f} с. {books_data.memory_report()}")
+        save_catalog_snapshot(catalog, signature)
+        threading.Thread(target=refresh_member_index, daemon=True).start()
+        return len(changed), len(removed)
 
-def search_book_smart(books_data, query):
+def watch_catalog_updates(inpx_path, interval, last_stat=None):
+    """
+    Фоновый поток: раз в interval секунд проверяет INPX и подхватывает новые архивы.
+    last_stat - размер и время изменения INPX, из которого загружен текущий каталог;
+    без него первое изменение лишь запоминается.
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            stat = os.stat(inpx_path)
+        except FileNotFoundError:
+            continue
+        current_stat = (stat.st_size, stat.st_mtime_ns)
+        if last_stat is not None and current_stat != last_stat:
+            logger.info("Обнаружено изменение INPX-файла, запускаем обновление каталога.")
+            try:
+                reload_catalog(inpx_path)
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления каталога: {e}", exc_info=True)
+        last_stat = current_stat
+
+def search_book(books_data, author, title, series, series_number, date, filters=NO_FILTERS):
+    """
+    Ищет книгу в списке данных по заданным критериям с учётом фильтров пользователя.
+    Возвращает курсор (SearchCursor), выдающий книги по релевантности постранично.
+    """
+    # Ключи книг уже нормализованы при загрузке каталога - нормализуем только запрос
+    criteria = {
+        'AUTHOR': normalize_query(author),
+        'TITLE': normalize_query(title),
+        'SERIES': normalize_query(series),
+        'SERNO': normalize_query(series_number),
+        'DATE': fold_text(date),
+    }
+    # Каталог (в памяти или в SQLite) сам выбирает индексы; книги ранжируются по релевантности
+    cursor = SearchCursor(books_data, 'fields', criteria, filters)
+    if not len(cursor):
+        # Точный поиск ничего не нашёл - пробуем исправить опечатки в авторе и серии
+        corrected = books_data.correct_fields(criteria)
+        if corrected:
+            fuzzy_cursor = SearchCursor(books_data, 'fields', corrected, filters)
+            if len(fuzzy_cursor):
+                fuzzy_cursor.corrected = ', '.join(value for value in corrected.values() if value)
+                logger.info(f"Последовательный поиск: критерии исправлены на {corrected}.")
+                return fuzzy_cursor
+    return cursor
+
+def search_book_smart(books_data, query, filters=NO_FILTERS):
     """
     Ищет книгу по одному запросу, ищет совпадения в авторе, названии, серии и номере серии,
-    с учетом нормализации двойных букв.
+    с учетом нормализации двойных букв, транслитерации и фильтров пользователя.
+    Возвращает курсор (SearchCursor), выдающий книги по релевантности постранично.
     """
-    results = []
     # Normalize the user's query
     normalized_query = normalize_query(query)
     query_parts = normalized_query.split()
 
-    for book in books_data:
-        # Create a search string from book info and normalize it
-        search_string = f"{book['AUTHOR']} {book['TITLE']} {book['SERIES']} {book['SERNO']}".lower()
-        normalized_search_string = normalize_query(search_string)
-        
-        # Check if all parts of the normalized query are in the normalized search string
-        if all(part in normalized_search_string for part in query_parts):
-            results.append(book)
-            
-    # Сортировка результатов по номеру серии
-    results.sort(key=lambda x: int(x.get('SERNO', '0')) if x.get('SERNO', '0').isdigit() else float('inf'))
-            
-            
-    return results
+    # Каждая часть запроса - вместе со своей транслитерацией: транслитерация только добавляет находки
+    query_pairs = tuple((part, translit_text(part)) for part in query_parts)
+
+    # Каталог (в памяти или в SQLite) сам выбирает индексы; книги ранжируются по релевантности
+    if re.search(r'[a-z]', normalized_query):
+        # В запросе есть латиница - ищем и подстроки, и транслитерацию (кириллица и латиница сразу)
+        cursor = SearchCursor(books_data, 'translit', query_pairs, filters)
+    else:
+        cursor = SearchCursor(books_data, 'smart', query_parts, filters)
+        if not len(cursor) and any(translit_part for _, translit_part in query_pairs):
+            # Кириллический запрос ничего не нашёл - ищем его транслитерацию среди книг на латинице
+            translit_cursor = SearchCursor(books_data, 'translit', query_pairs, filters)
+            if len(translit_cursor):
+                return translit_cursor
+    if not len(cursor) and query_parts:
+        # Точный поиск ничего не нашёл - пробуем исправить опечатки в словах авторов и серий
+        corrected = books_data.correct_smart(query_parts)
+        if corrected:
+            fuzzy_cursor = SearchCursor(books_data, 'smart', corrected, filters)
+            if len(fuzzy_cursor):
+                fuzzy_cursor.corrected = ' '.join(corrected)
+                logger.info(f"Умный поиск: запрос '{normalized_query}' исправлен на '{fuzzy_cursor.corrected}'.")
+                return fuzzy_cursor
+    return cursor
 
 def sanitize_filename(filename):
     """
@@ -823,54 +3391,92 @@ def sanitize_filename(filename):
     sanitized_name = sanitized_name.strip('_')
     return sanitized_name
 
-def get_book_file(book_info):
+def book_file_name(book_info):
     """
-    Находит и извлекает файл книги из соответствующего ZIP-архива.
-    Возвращает путь к сохраненному файлу или None в случае ошибки.
+    Формирует имя файла книги для отправки пользователю: очищенное название и расширение.
     """
-    file_name_in_zip = f"{book_info['FILE']}.{book_info['EXT']}"
-    archive_name = book_info['INP_ARCHIVE_NAME']
-    archive_path = os.path.join(BOOKS_DIR, 'lib.rus.ec', archive_name)
-    
-    os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
-    
     # Формируем имя файла из названия книги и расширения
     title_part = book_info['TITLE']
     extension_part = book_info['EXT']
     
     # Очищаем имя файла от запрещенных символов
     sanitized_title = sanitize_filename(title_part)
-    # Определяем максимальную безопасную длину имени файла (например, 200 символов)
-    # Это позволяет избежать ошибки WinError 3
+    # Ограничиваем длину имени файла (100 символов вместе с расширением)
     max_len = 100 - len(f".{extension_part}")
     
     if len(sanitized_title) > max_len:
         # Если имя слишком длинное, обрезаем его
-        truncated_title = sanitized_title[:max_len]
-        temp_filename = f"{truncated_title}.{extension_part}"
-        logger.warning(f"Имя файла было слишком длинным и обрезано: {temp_filename}")
-    else:
-        temp_filename = f"{sanitized_title}.{extension_part}"
-        
-    output_path = os.path.join(DOWNLOAD_FOLDER, temp_filename)
+        file_name = f"{sanitized_title[:max_len]}.{extension_part}"
+        logger.warning(f"Имя файла было слишком длинным и обрезано: {file_name}")
+        return file_name
+    return f"{sanitized_title}.{extension_part}"
+
+def open_book_stream(book_info):
+    """
+    Читает файл книги из соответствующего ZIP-архива в поток, не создавая файлов
+    с общим именем на диске. Книги до STREAM_MAX_BYTES остаются в памяти, более
+    крупные переносятся во временный безымянный файл в DOWNLOAD_FOLDER.
+    Возвращает пару (поток, имя файла для пользователя) или (None, None) в случае ошибки.
+    Поток нужно закрыть после использования.
+    """
+    file_name_in_zip = f"{book_info['FILE']}.{book_info['EXT']}"
+    archive_name = book_info['INP_ARCHIVE_NAME']
+    archive_path = os.path.join(BOOKS_DIR, 'lib.rus.ec', archive_name)
     
+    stream = None
     try:
-        with zipfile.ZipFile(archive_path, 'r') as archive:
-            # Извлекаем файл под его оригинальным именем
-            extracted_file_path = os.path.join(DOWNLOAD_FOLDER, file_name_in_zip)
-            archive.extract(file_name_in_zip, DOWNLOAD_FOLDER)
-            
-            # Если файл успешно извлечен, переименовываем его в новое имя
-            if os.path.exists(extracted_file_path):
-                os.rename(extracted_file_path, output_path)
-                logger.info(f"Файл '{file_name_in_zip}' успешно извлечен и переименован в '{temp_filename}'.")
-                return output_path
-            else:
-                logger.error(f"Не удалось найти извлеченный файл: {extracted_file_path} из архива {archive_name}")
-                return None
+        os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+        stream = tempfile.SpooledTemporaryFile(max_size=STREAM_MAX_BYTES, dir=DOWNLOAD_FOLDER)
+        try:
+            copied = member_index.copy(archive_name, file_name_in_zip, stream)
+        except (OSError, zlib.error, zipfile.BadZipFile) as e:
+            logger.warning(f"Не удалось прочитать '{file_name_in_zip}' по индексу архивов, читаем через zipfile: {e}")
+            stream.seek(0)
+            stream.truncate()
+            copied = False
+        if not copied:
+            with archive_pool.open(archive_path, file_name_in_zip) as source:
+                shutil.copyfileobj(source, stream, STREAM_CHUNK_SIZE)
+        stream.seek(0)
+        file_name = book_file_name(book_info)
+        logger.info(f"Файл '{file_name_in_zip}' прочитан из архива '{archive_name}' как '{file_name}'.")
+        return stream, file_name
     except (FileNotFoundError, KeyError, Exception) as e:
+        if stream is not None:
+            stream.close()
         logger.error(f"Ошибка при извлечении файла '{file_name_in_zip}' из архива '{archive_name}': {e}")
-        return None
+        return None, None
+
+def send_book_document(chat_id, book_info, **kwargs):
+    """
+    Отправляет файл книги пользователю. Если книга уже загружалась в Telegram,
+    отправляет её по сохранённому file_id без извлечения из архива и повторной загрузки;
+    если Telegram этот file_id не принимает, загружает файл заново.
+    Возвращает False, если файл книги не удалось прочитать из архива.
+    """
+    libid = book_info['LIBID']
+    file_id = load_telegram_file_id(libid)
+    if file_id:
+        try:
+            bot.send_document(chat_id, file_id, **kwargs)
+            logger.info(f"Книга LIBID {libid} отправлена пользователю {chat_id} по file_id.")
+            return True
+        except ApiTelegramException as e:
+            description = (e.description or '').lower()
+            if e.error_code != 400 or not any(error in description for error in INVALID_FILE_ID_ERRORS):
+                raise
+            logger.warning(f"Telegram не принял сохраненный file_id книги LIBID {libid}, загружаем файл заново: {e}")
+            delete_telegram_file_id(libid)
+
+    book_stream, book_name = open_book_stream(book_info)
+    if not book_stream:
+        return False
+    with book_stream:
+        message = bot.send_document(chat_id, book_stream, visible_file_name=book_name, **kwargs)
+    document = getattr(message, 'document', None)
+    if document is not None:
+        save_telegram_file_id(libid, document.file_id)
+    return True
 
 def get_dir_size_gb(path):
     """
@@ -996,11 +3602,14 @@ def remove_user(user_id):
 user_keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
 user_keyboard.row('Инфо', 'Мои книги')
 user_keyboard.row('Умный поиск', 'Последовательный поиск')
+user_keyboard.row('Жанры', 'Фильтры')
 
 admin_keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
 admin_keyboard.row('Инфо', 'Мои книги')
 admin_keyboard.row('Умный поиск', 'Последовательный поиск')
+admin_keyboard.row('Жанры', 'Фильтры')
 admin_keyboard.row('Список пользователей', 'Заявки на одобрение')
+admin_keyboard.row('Статистика', 'Обновить каталог')
 admin_keyboard.row('Перезапустить бота')
 
 def get_keyboard(user_id):
@@ -1040,6 +3649,22 @@ def check_for_button_press(message):
         bot.send_message(message.chat.id, "Поиск прерван.", reply_markup=get_keyboard(message.from_user.id))
         handle_my_books(message)
         return True
+    elif message.text == 'Жанры':
+        bot.send_message(message.chat.id, "Поиск прерван.", reply_markup=get_keyboard(message.from_user.id))
+        handle_genres_button(message)
+        return True
+    elif message.text == 'Фильтры':
+        bot.send_message(message.chat.id, "Поиск прерван.", reply_markup=get_keyboard(message.from_user.id))
+        handle_filters_button(message)
+        return True
+    elif message.text == 'Статистика' and is_user_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "Поиск прерван.", reply_markup=get_keyboard(message.from_user.id))
+        handle_admin_stats(message)
+        return True
+    elif message.text == 'Обновить каталог' and is_user_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "Поиск прерван.", reply_markup=get_keyboard(message.from_user.id))
+        handle_admin_reload(message)
+        return True
     return False
 
 # захват ссылок с Либрусека
@@ -1067,7 +3692,7 @@ def handle_librus_link_message(message):
         libid = match.group(1)
         logger.info(f"Пользователь {chat_id} отправил ссылку, найден LIBID: {libid}")
 
-        selected_book = next((book for book in books_data if book['LIBID'] == libid), None)
+        selected_book = books_data.find('LIBID', libid)
 
         if not selected_book:
             bot.send_message(chat_id, "Произошла ошибка: книга с таким LIBID не найдена в базе.", reply_markup=get_keyboard(chat_id))
@@ -1075,43 +3700,34 @@ def handle_librus_link_message(message):
             return
 
         bot.send_message(chat_id, f"Начинаю скачивание книги: {selected_book['TITLE']}...")
-        file_path = get_book_file(selected_book)
-
-        if file_path and os.path.exists(file_path):
-            try:
-                with open(file_path, 'rb') as book_file:
-                    full_filename = f"Автор: {selected_book['AUTHOR']}\nНазвание книги: {selected_book['TITLE']}\nСерия: {selected_book['SERIES']}\nНомер в серии: {selected_book['SERNO']}"
-                    bot.send_document(chat_id, book_file, caption=f"{full_filename}\nСсылка на сайт: [link](http://lib.rus.ec/b/{libid})", parse_mode="Markdown")
+        try:
+            full_filename = f"Автор: {selected_book['AUTHOR']}\nНазвание книги: {selected_book['TITLE']}\nСерия: {selected_book['SERIES']}\nНомер в серии: {selected_book['SERNO']}"
+            if not send_book_document(chat_id, selected_book, caption=f"{full_filename}\nСсылка на сайт: [link](http://lib.rus.ec/b/{libid})", parse_mode="Markdown"):
+                bot.send_message(chat_id, "Произошла ошибка при скачивании файла.", reply_markup=get_keyboard(chat_id))
+                return
 
-                # --- добавляем кнопку "Читать книгу" ---
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(InlineKeyboardButton("📕 Читать книгу", callback_data=f"add_book:{selected_book['LIBID']}"))                    
-                    
-                    
-                bot.send_message(
-                    chat_id,
-                    "Книга отправлена. \nЗагрузите данный файл на ваше устройство и откройте читалкой FB2 файлов. \n\n"
-                    "Также вы можете выбрать другую книгу из списка выше, либо начать новый поиск.\n\n"
-                    "Или воспользуйтесь встроенным ридером:",
-                    reply_markup=keyboard
-                )
-                
+            # --- добавляем кнопку "Читать книгу" ---
+            keyboard = InlineKeyboardMarkup()
+            keyboard.add(InlineKeyboardButton("📕 Читать книгу", callback_data=f"add_book:{selected_book['LIBID']}"))                    
                 
                 
-                logger.info(f"Файл книги '{selected_book['TITLE']}' успешно отправлен пользователю {chat_id}.")
-            except ApiTelegramException as e:
-                logger.error(f"Telegram API Error while sending file to {chat_id}: {e}")
-                bot.send_message(chat_id, "Произошла ошибка при отправке файла. Возможно, он слишком большой.", reply_markup=get_keyboard(chat_id))
-            except Exception as e:
-                logger.error(f"Ошибка при отправке файла '{selected_book['TITLE']}': {e}")
-                bot.send_message(chat_id, f"Произошла ошибка при отправке файла: {e}", reply_markup=get_keyboard(chat_id))
-            finally:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.info(f"Файл '{selected_book['TITLE']}' удален.")
-        else:
-            bot.send_message(chat_id, "Произошла ошибка при скачивании файла.", reply_markup=get_keyboard(chat_id))
-
+            bot.send_message(
+                chat_id,
+                "Книга отправлена. \nЗагрузите данный файл на ваше устройство и откройте читалкой FB2 файлов. \n\n"
+                "Также вы можете выбрать другую книгу из списка выше, либо начать новый поиск.\n\n"
+                "Или воспользуйтесь встроенным ридером:",
+                reply_markup=keyboard
+            )
+            
+            
+            
+            logger.info(f"Файл книги '{selected_book['TITLE']}' успешно отправлен пользователю {chat_id}.")
+        except ApiTelegramException as e:
+            logger.error(f"Telegram API Error while sending file to {chat_id}: {e}")
+            bot.send_message(chat_id, "Произошла ошибка при отправке файла. Возможно, он слишком большой.", reply_markup=get_keyboard(chat_id))
+        except Exception as e:
+            logger.error(f"Ошибка при отправке файла '{selected_book['TITLE']}': {e}")
+            bot.send_message(chat_id, f"Произошла ошибка при отправке файла: {e}", reply_markup=get_keyboard(chat_id))
     finally:
         is_processing_link[chat_id] = False
 
@@ -1164,8 +3780,56 @@ def handle_admin_restart(message):
     user_id = message.from_user.id
     logger.info(f"Администратор {user_id} запросил перезапуск.")
     bot.send_message(user_id, "Перезапускаю бота...")
+    # execv не вызывает обработчики atexit: сохраняем прогресс чтения и закрываем базу явно
+    progress_buffer.flush()
+    close_db_connections()
     os.execv(sys.executable, ['python'] + sys.argv)
 
+@bot.message_handler(commands=['reload'], func=lambda m: is_user_admin(m.from_user.id))
+@bot.message_handler(func=lambda message: message.text == 'Обновить каталог' and is_user_admin(message.from_user.id))
+def handle_admin_reload(message):
+    """Обработчик кнопки 'Обновить каталог': подхватывает новые архивы без перезапуска."""
+    user_id = message.from_user.id
+    logger.info(f"Администратор {user_id} запросил обновление каталога.")
+
+    if catalog_reload_lock.locked():
+        bot.send_message(message.chat.id, "Обновление каталога уже выполняется.")
+        return
+
+    def run_reload():
+        result = reload_catalog(INPX_FILE)
+        if result is None:
+            bot.send_message(message.chat.id, "Не удалось обновить каталог, подробности в логе.")
+        elif result == (0, 0):
+            bot.send_message(message.chat.id, f"Изменений нет. Книг в базе: {len(books_data)}.")
+        else:
+            changed, removed = result
+            bot.send_message(message.chat.id,
+                             f"Каталог обновлен: перечитано INP-файлов: {changed}, удалено: {removed}.\n"
+                             f"Книг в базе: {len(books_data)}.")
+
+    bot.send_message(message.chat.id, "Обновляю каталог. Поиск продолжает работать по текущей базе.")
+    threading.Thread(target=run_reload, daemon=True).start()
+
+@bot.message_handler(commands=['stats'], func=lambda m: is_user_admin(m.from_user.id))
+@bot.message_handler(func=lambda message: message.text == 'Статистика' and is_user_admin(message.from_user.id))
+def handle_admin_stats(message):
+    """Показывает администратору статистику каталога."""
+    user_id = message.from_user.id
+    logger.info(f"Администратор {user_id} запросил статистику.")
+
+    lines = [books_data.memory_report()]
+    for field, size in sorted(books_data.memory_usage().items(), key=lambda item: -item[1]):
+        lines.append(f"  {field}: {size / 1024:.0f} КБ")
+    lines.append(query_cache.report())
+    lines.append(reader_storage_report())
+    lines.append(reader_stats.report())
+    lines.append(progress_buffer.report())
+    lines.append(archive_pool.report())
+    lines.append(member_index.report())
+
+    bot.send_message(message.chat.id, "\n".join(lines), reply_markup=get_keyboard(user_id))
+
 @bot.message_handler(func=lambda message: message.text == 'Список пользователей' and is_user_admin(message.from_user.id))
 def handle_list_users(message):
     """Показывает список одобренных пользователей с кнопками для удаления."""
@@ -1245,7 +3909,8 @@ def handle_info_button(message):
         f"Всего пользователей бота: {len(registered_users)}\n\n"
         "Обновление раздачи планируется осуществлять в начале каждого календарного месяца путём добавления нового архива с книгами, в накопительном режиме.\n\n"
         "Последние новости по работе бота и его обновлениям, можно посмотреть и обсудить в [группе](https://t.me/flibusta_librusec/3/9).\n\n"
-        "Чтобы начать поиск книги, нажми на одну из кнопок поиска ниже. \n\n"
+        "Чтобы начать поиск книги, нажми на одну из кнопок поиска ниже. \n"
+        "Язык, формат и показ удалённых книг настраиваются кнопкой «Фильтры». \n\n"
         "Чем открыть файл FB2 можешь узнать тут: /reader \n\n"
         f"Если не нашел свою книгу в LibRusEc, можно поискать ее на [Flibusta](https://t.me/FlibustaBase_bot).\n\n"
         "Написать автору бота можно тут: [PostToMe](https://t.me/PostToMe_bot)\n\n"
@@ -1382,7 +4047,7 @@ def process_sequential_search(message):
         return
 
     bot.send_message(chat_id, "Ищу книги по вашим критериям...")
-    found_books = search_book(books_data, author, title, series, series_number, date)
+    found_books = search_book(books_data, author, title, series, series_number, date, load_user_filters(chat_id))
     
     user_search_results[chat_id] = {
         'results': found_books,
@@ -1421,7 +4086,7 @@ def process_smart_search_and_display(message):
 
     logger.info(f"Умный поиск: пользователь {chat_id} ввёл запрос: '{query}'")
     bot.send_message(chat_id, f"Выполняю умный поиск по запросу: \"{query}\"...")
-    found_books = search_book_smart(books_data, query)
+    found_books = search_book_smart(books_data, query, load_user_filters(chat_id))
     
     user_search_results[chat_id] = {
         'results': found_books,
@@ -1430,6 +4095,142 @@ def process_smart_search_and_display(message):
     display_results(chat_id)
 
 
+def describe_filters(filters):
+    """Текстовое описание фильтров поиска пользователя."""
+    hide_deleted, languages, formats = filters
+    return (f"Удалённые книги: {'скрыты' if hide_deleted else 'показываются'}\n"
+            f"Языки: {', '.join(languages) if languages else 'все'}\n"
+            f"Форматы: {', '.join(formats) if formats else 'все'}")
+
+def get_filters_keyboard(filters):
+    """Создает клавиатуру фильтров поиска: удалённые книги, языки и форматы."""
+    hide_deleted, languages, formats = filters
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton(f"{'✅' if hide_deleted else '⬜'} Скрывать удалённые", callback_data="filter:del"))
+    for field, prefix, selected in (('LANG', 'lang', languages), ('EXT', 'ext', formats)):
+        values = list(dict.fromkeys(list(selected) + books_data.filter_values(field, FILTER_BUTTONS)))
+        buttons = [InlineKeyboardButton(f"{'✅ ' if value in selected else ''}{value}", callback_data=f"filter:{prefix}:{value}")
+                   for value in values]
+        for i in range(0, len(buttons), 4):
+            markup.row(*buttons[i:i + 4])
+    markup.row(InlineKeyboardButton("Сбросить", callback_data="filter:reset"))
+    return markup
+
+@bot.message_handler(func=lambda message: message.text == 'Фильтры' and is_user_approved(message.from_user.id))
+def handle_filters_button(message):
+    """Показывает фильтры поиска пользователя с кнопками для их изменения."""
+    chat_id = message.chat.id
+    filters = load_user_filters(chat_id)
+    bot.send_message(chat_id, f"Фильтры поиска:\n{describe_filters(filters)}", reply_markup=get_filters_keyboard(filters))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('filter:'))
+def handle_filter_callback(call):
+    if not is_user_approved(call.from_user.id):
+        bot.answer_callback_query(call.id, text="У вас нет доступа к этому боту.")
+        return
+
+    chat_id = call.message.chat.id
+    parts = call.data.split(':', 2)
+    hide_deleted, languages, formats = load_user_filters(chat_id)
+    if parts[1] == 'del':
+        hide_deleted = not hide_deleted
+    elif parts[1] == 'lang':
+        languages = tuple(sorted(set(languages) ^ {parts[2]}))
+    elif parts[1] == 'ext':
+        formats = tuple(sorted(set(formats) ^ {parts[2]}))
+    elif parts[1] == 'reset':
+        hide_deleted, languages, formats = DEFAULT_SEARCH_FILTERS
+    filters = (hide_deleted, languages, formats)
+    save_user_filters(chat_id, filters)
+
+    try:
+        bot.edit_message_text(f"Фильтры поиска:\n{describe_filters(filters)}", chat_id=chat_id,
+                              message_id=call.message.message_id, reply_markup=get_filters_keyboard(filters))
+    except ApiTelegramException as e:
+        logger.debug(f"Сообщение с фильтрами не изменено: {e}")
+    bot.answer_callback_query(call.id, text="Фильтры сохранены.")
+
+
+def get_genre_groups_keyboard(filters=NO_FILTERS):
+    """Создает клавиатуру групп жанров с числом книг в каждой (с учётом фильтров пользователя)."""
+    groups = {}
+    for code, number in books_data.genre_counts(filters).items():
+        group = code.split('_')[0]
+        groups[group] = groups.get(group, 0) + number
+    markup = InlineKeyboardMarkup()
+    buttons = [InlineKeyboardButton(f"{GENRE_GROUPS.get(group, group)} ({number})", callback_data=f"genres:{group}")
+               for group, number in sorted(groups.items(), key=lambda item: -item[1])]
+    for i in range(0, len(buttons), 2):
+        markup.row(*buttons[i:i + 2])
+    return markup
+
+def get_genres_keyboard(group, filters=NO_FILTERS):
+    """Создает клавиатуру жанров одной группы с числом книг в каждом (с учётом фильтров пользователя)."""
+    counts = books_data.genre_counts(filters)
+    codes = sorted((code for code in counts if code.split('_')[0] == group), key=lambda code: -counts[code])
+    markup = InlineKeyboardMarkup()
+    buttons = [InlineKeyboardButton(f"{code} ({counts[code]})", callback_data=f"genre:{code}") for code in codes]
+    for i in range(0, len(buttons), 2):
+        markup.row(*buttons[i:i + 2])
+    markup.row(InlineKeyboardButton("⬅️ Все жанры", callback_data="genres"))
+    return markup
+
+def display_facet(chat_id, mode, value, title):
+    """Показывает книги жанра, серии или автора из предвычисленных фасетов каталога."""
+    cursor = SearchCursor(books_data, mode, (value,), load_user_filters(chat_id))
+    cursor.title = title
+    user_search_results[chat_id] = {
+        'results': cursor,
+        'page': 0
+    }
+    display_results(chat_id)
+
+@bot.message_handler(func=lambda message: message.text == 'Жанры' and is_user_approved(message.from_user.id))
+def handle_genres_button(message):
+    """Показывает группы жанров каталога."""
+    chat_id = message.chat.id
+    logger.info(f"Пользователь {chat_id} открыл список жанров.")
+    bot.send_message(chat_id, "Выберите группу жанров:", reply_markup=get_genre_groups_keyboard(load_user_filters(chat_id)))
+
+@bot.callback_query_handler(func=lambda call: call.data == 'genres' or call.data.startswith('genres:'))
+def handle_genres_callback(call):
+    if not is_user_approved(call.from_user.id):
+        bot.answer_callback_query(call.id, text="У вас нет доступа к этому боту.")
+        return
+
+    chat_id = call.message.chat.id
+    filters = load_user_filters(chat_id)
+    if call.data == 'genres':
+        text, markup = "Выберите группу жанров:", get_genre_groups_keyboard(filters)
+    else:
+        group = call.data.split(':', 1)[1]
+        text, markup = f"Жанры группы «{GENRE_GROUPS.get(group, group)}»:", get_genres_keyboard(group, filters)
+    bot.edit_message_text(text, chat_id=chat_id, message_id=call.message.message_id, reply_markup=markup)
+    bot.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(('genre:', 'series:', 'author:')))
+def handle_facet_callback(call):
+    if not is_user_approved(call.from_user.id):
+        bot.answer_callback_query(call.id, text="У вас нет доступа к этому боту.")
+        return
+
+    chat_id = call.message.chat.id
+    mode, value = call.data.split(':', 1)
+    if mode == 'genre':
+        logger.info(f"Пользователь {chat_id} просматривает жанр '{value}'.")
+        display_facet(chat_id, 'genre', value, f"Жанр {value}")
+    else:
+        book = books_data.find('LIBID', value)
+        if not book:
+            bot.answer_callback_query(call.id, text="Книга не найдена.")
+            return
+        field = 'SERIES' if mode == 'series' else 'AUTHOR'
+        logger.info(f"Пользователь {chat_id} просматривает все книги: {field}='{book[field]}'.")
+        title = f"Серия «{book['SERIES']}»" if mode == 'series' else f"Книги автора {book['AUTHOR']}"
+        display_facet(chat_id, mode, normalize_query(book[field]), title)
+    bot.answer_callback_query(call.id)
+
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith('download:'))
 def handle_download_callback(call):
     chat_id = call.message.chat.id
@@ -1439,54 +4240,54 @@ def handle_download_callback(call):
 
     book_libid = call.data.split(':')[1]
     
-    selected_book = next((book for book in books_data if book['LIBID'] == book_libid), None)
+    selected_book = books_data.find('LIBID', book_libid)
     
     if not selected_book:
         bot.send_message(chat_id, "Произошла ошибка: книга не найдена.")
         return
 
-    # Запускаем извлечение файла
-    file_path = get_book_file(selected_book)
-    
-    if file_path and os.path.exists(file_path):
-        try:
-            with open(file_path, 'rb') as book_file:
-                link_book = selected_book['LIBID']
-                full_filename = (
-                    f"Автор: {selected_book['AUTHOR']}\n"
-                    f"Название книги: {selected_book['TITLE']}\n"
-                    f"Серия: {selected_book['SERIES']}\n"
-                    f"Номер в серии: {selected_book['SERNO']}"
-                )
-                bot.send_document(
-                    chat_id,
-                    book_file,
-                    caption=f"{full_filename}\nСсылка на сайт: [link](http://lib.rus.ec/b/{link_book})",
-                    parse_mode="Markdown"
-                )
-            
-            # --- добавляем кнопку "Читать книгу" ---
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton("📕 Читать книгу", callback_data=f"add_book:{selected_book['LIBID']}"))
-
-            bot.send_message(
-                chat_id,
-                "Книга отправлена. \nЗагрузите данный файл на ваше устройство и откройте читалкой FB2 файлов. \n\n"
-                "Также вы можете выбрать другую книгу из списка выше, либо начать новый поиск.\n\n"
-                "Или воспользуйтесь встроенным ридером:",
-                reply_markup=keyboard
-            )
+    # Отправляем файл (по сохранённому file_id или извлекая из архива)
+    try:
+        link_book = selected_book['LIBID']
+        full_filename = (
+            f"Автор: {selected_book['AUTHOR']}\n"
+            f"Название книги: {selected_book['TITLE']}\n"
+            f"Серия: {selected_book['SERIES']}\n"
+            f"Номер в серии: {selected_book['SERNO']}"
+        )
+        if not send_book_document(
+            chat_id,
+            selected_book,
+            caption=f"{full_filename}\nСсылка на сайт: [link](http://lib.rus.ec/b/{link_book})",
+            parse_mode="Markdown"
+        ):
+            bot.send_message(chat_id, "Произошла ошибка при скачивании файла.", reply_markup=get_keyboard(chat_id))
+            return
+        
+        # --- добавляем кнопку "Читать книгу" ---
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(InlineKeyboardButton("📕 Читать книгу", callback_data=f"add_book:{selected_book['LIBID']}"))
+        filters = load_user_filters(chat_id)
+        if selected_book['SERIES']:
+            series_count = books_data.facet_count('SERIES', normalize_query(selected_book['SERIES']), filters)
+            keyboard.add(InlineKeyboardButton(f"📚 Все книги серии ({series_count})",
+                                              callback_data=f"series:{selected_book['LIBID']}"))
+        author_count = books_data.facet_count('AUTHOR', normalize_query(selected_book['AUTHOR']), filters)
+        keyboard.add(InlineKeyboardButton(f"👤 Все книги автора ({author_count})",
+                                          callback_data=f"author:{selected_book['LIBID']}"))
+
+        bot.send_message(
+            chat_id,
+            "Книга отправлена. \nЗагрузите данный файл на ваше устройство и откройте читалкой FB2 файлов. \n\n"
+            "Также вы можете выбрать другую книгу из списка выше, либо начать новый поиск.\n\n"
+            "Или воспользуйтесь встроенным ридером:",
+            reply_markup=keyboard
+        )
 
-            logger.info(f"Файл книги '{selected_book['TITLE']}' успешно отправлен пользователю {chat_id}.")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке файла '{selected_book['TITLE']}': {e}")
-            bot.send_message(chat_id, f"Произошла ошибка при отправке файла: {e}", reply_markup=get_keyboard(chat_id))
-        finally:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"Файл '{selected_book['TITLE']}' удален.")
-    else:
-        bot.send_message(chat_id, "Произошла ошибка при скачивании файла.", reply_markup=get_keyboard(chat_id))
+        logger.info(f"Файл книги '{selected_book['TITLE']}' успешно отправлен пользователю {chat_id}.")
+    except Exception as e:
+        logger.error(f"Ошибка при отправке файла '{selected_book['TITLE']}': {e}")
+        bot.send_message(chat_id, f"Произошла ошибка при отправке файла: {e}", reply_markup=get_keyboard(chat_id))
 
 
 def process_and_save_book(chat_id, file_content):
@@ -1499,16 +4300,17 @@ def process_and_save_book(chat_id, file_content):
         bot.send_message(chat_id, "Не удалось прочитать книгу\\. Возможно, файл поврежден\\.", parse_mode="MarkdownV2")
         return
     
-    total_pages = (len(book_text) + PAGE_SIZE - 1) // PAGE_SIZE
+    book_text, page_offsets = paginate_book(book_text)
+    total_pages = len(page_offsets) // 2
     
-    save_result = save_user_state(chat_id, title, author, series, series_number, book_text, 0, total_pages)
+    save_result = save_user_book(chat_id, title, author, series, series_number, book_text, page_offsets)
     if save_result == 'limit_reached':
         bot.send_message(chat_id, f"Вы достигли лимита в {MAX_BOOKS} книг\\. Пожалуйста, удалите одну из старых книг с помощью команды /mybooks, чтобы добавить новую\\.", parse_mode="MarkdownV2")
         return
     
     book_id = hashlib.sha256(f"{chat_id}{title}{author}{series}{series_number}".encode('utf-8')).hexdigest()
     
-    first_page_text = get_page_text(book_text, 0)
+    first_page_text = get_page_text(book_text, page_offsets, 0)
     
     response_text = f"**Начинаем читать:** {escape_markdown(title)}\n"
     if series and series != "Нет серии":
@@ -1530,25 +4332,22 @@ def handle_add_book_callback(call):
     book_file_name = call.data.split(':')[1]
     
     # Найдите информацию о книге по имени файла
-    book_info = next((book for book in books_data if book['FILE'] == book_file_name), None)
+    book_info = books_data.find('FILE', book_file_name)
     
     if not book_info:
         bot.answer_callback_query(call.id, "Информация о книге не найдена.")
         return
         
     try:
-        # Получаем путь к файлу книги
-        book_path = get_book_file(book_info)
-        if not book_path:
+        # Читаем файл книги из архива
+        book_stream, _ = open_book_stream(book_info)
+        if not book_stream:
             bot.send_message(chat_id, "Не удалось найти файл книги. Попробуйте другой вариант.")
             bot.answer_callback_query(call.id)
             return
 
-        with open(book_path, 'rb') as f:
-            file_content = f.read()
-        
-        # Удаляем временный файл
-        os.remove(book_path)
+        with book_stream:
+            file_content = book_stream.read()
         
         # Парсим и сохраняем книгу
         process_and_save_book(chat_id, file_content)
@@ -1578,6 +4377,11 @@ def display_results(chat_id):
     total_pages = (total_books + results_per_page - 1) // results_per_page
 
     response_text = f"Найдено {total_books} книг. Страница {current_page + 1} из {total_pages}:\n\n"
+    if found_books.corrected:
+        response_text = (f"Точных совпадений нет, показаны результаты для «{html.escape(found_books.corrected)}».\n"
+                         + response_text)
+    if found_books.title:
+        response_text = f"<b>{html.escape(found_books.title)}</b>\n" + response_text
     
     download_keyboard = InlineKeyboardMarkup()
     download_buttons = []
@@ -1605,6 +4409,17 @@ def display_results(chat_id):
     for i in range(0, len(download_buttons), buttons_per_row):
         download_keyboard.row(*download_buttons[i:i + buttons_per_row])
     
+    # Кнопки просмотра всех книг серий, встретившихся на странице
+    if found_books.mode != 'series':
+        shown_series = []
+        for book in books_to_display:
+            series = book['SERIES']
+            if series and series not in shown_series and len(shown_series) < FACET_BUTTONS:
+                shown_series.append(series)
+                series_count = found_books.catalog.facet_count('SERIES', normalize_query(series), found_books.filters)
+                download_keyboard.row(InlineKeyboardButton(text=f"📚 Все книги серии «{series[:30]}» ({series_count})",
+                                                           callback_data=f"series:{book['LIBID']}"))
+
     # --- ДОБАВЛЕНИЕ НОВОГО ТЕКСТА ---
     response_text += "\nДля скачки выбранной книги, нажмите кнопку с ее номером."
 
@@ -1750,11 +4565,7 @@ def handle_book_selection(message):
             logger.info(f"Пользователь {chat_id} выбрал книгу: '{selected_book['TITLE']}' (ID: {index + 1})")
             bot.send_message(chat_id, f"Вы выбрали книгу: {selected_book['TITLE']}. Начинаю скачивание...")
             
-            file_path = get_book_file(selected_book)
-            if file_path and os.path.exists(file_path):
-                with open(file_path, 'rb') as book_file:
-                    bot.send_document(chat_id, book_file)
-                os.remove(file_path)
+            if send_book_document(chat_id, selected_book):
                 logger.info(f"Файл книги '{selected_book['TITLE']}' успешно отправлен пользователю {chat_id}.")
                 bot.send_message(chat_id, "Готово! Можете выбрать другое действие.", reply_markup=get_keyboard(chat_id))
             else:
@@ -1779,15 +4590,26 @@ if __name__ == '__main__':
     logger.info("Запуск бота. Инициализация каталога библиотеки...")
     load_users()
     load_pending_users()
+    create_table()
+    # Прогресс чтения пишется в базу в фоне и обязательно - при остановке бота, после чего
+    # журнал WAL переносится в базу (atexit вызывает обработчики в обратном порядке)
+    atexit.register(close_db_connections)
+    atexit.register(progress_buffer.flush)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if PROGRESS_FLUSH_INTERVAL > 0:
+        threading.Thread(target=progress_buffer.run, daemon=True).start()
     if load_inpx_data(INPX_FILE):
         logger.info(f"Каталог загружен. Всего книг: {len(books_data)}.")
+        threading.Thread(target=refresh_member_index, daemon=True).start()
+        if CATALOG_WATCH_INTERVAL > 0:
+            threading.Thread(target=watch_catalog_updates, args=(INPX_FILE, CATALOG_WATCH_INTERVAL, loaded_inpx_stat), daemon=True).start()
+            logger.info(f"Фоновая проверка обновлений INPX каждые {CATALOG_WATCH_INTERVAL} с.")
         logger.info("Бот запущен. Начните общение в Telegram.")
         while True:
             try:
                 bot.polling(none_stop=True)
             except Exception as e:
                 logger.error(f"Ошибка в основном цикле. Перезапускаю бота. Ошибка: {e}", exc_info=True)
-                import time
                 time.sleep(5)
     else:
         logger.error("Не удалось загрузить каталог. Бот не будет запущен.")
\ No newline at end of file
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import zipfile
+
+import pytest
+
+os.environ.setdefault('BOT_TOKEN', '0:test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Librusec_bot as bot_module  # noqa: E402
+
+BOOKS = [
+    ('Bulgakov,Mikhail,:', 'The Master'),
+    ('Schwartz,Evgeny,:', 'Dragon'),
+    ('Pushkin,Alexander,:', 'Tsar'),
+    ('Булгаков,Михаил,:', 'Мастер и Маргарита'),
+    ('Шварц,Евгений,:', 'Дракон'),
+]
+
+
+@pytest.fixture(scope='module')
+def inpx_path(tmp_path_factory):
+    root = tmp_path_factory.mktemp('library')
+    lines = ['\x04'.join([author, 'prose:', title, '', '', str(100 + i), '10', str(100 + i),
+                          '0', 'fb2', '2020-01-01', 'ru', '', '']) + '\x04'
+             for i, (author, title) in enumerate(BOOKS)]
+    path = str(root / 'test.inpx')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('100-199.inp', '\r\n'.join(lines).encode('utf-8'))
+    return path
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def catalog(request, inpx_path, tmp_path):
+    if request.param == 'memory':
+        catalog = bot_module.parse_inpx_catalog(inpx_path)
+    else:
+        db_path = str(tmp_path / 'catalog.db')
+        assert bot_module.build_sqlite_catalog(inpx_path, db_path, bot_module.inpx_signature(inpx_path))
+        catalog = bot_module.SqliteCatalog(db_path)
+        while not catalog.fuzzy_indexes:
+            time.sleep(0.01)
+    bot_module.set_catalog(catalog)
+    return catalog
+
+
+def titles(catalog, query):
+    cursor = bot_module.search_book_smart(catalog, query)
+    return [book['TITLE'] for book in cursor[0:len(cursor)]], cursor.corrected
+
+
+@pytest.mark.parametrize('query, title', [
+    ('mik', 'The Master'),        # 'mikhail': kh -> h
+    ('schwart', 'Dragon'),        # 'schwartz': sch -> sh, tz -> c
+    ('sar', 'Tsar'),              # 'tsar': ts -> c
+    ('bulgakov mik', 'The Master'),
+])
+def test_latin_substring_across_digraph_boundary(catalog, query, title):
+    found, corrected = titles(catalog, query)
+    assert title in found
+    assert corrected is None
+
+
+def test_latin_query_also_finds_cyrillic_books(catalog):
+    found, _ = titles(catalog, 'shvarc')
+    assert set(found) == {'Dragon', 'Дракон'}
+
+
+def test_latin_query_falls_back_to_typo_correction(catalog):
+    found, corrected = titles(catalog, 'bulgakof')
+    assert corrected == 'bulgakov'
+    assert 'The Master' in found